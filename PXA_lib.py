@@ -3,8 +3,10 @@ import visa
 import numpy as np
 import time
 import sys
+import scpi_lib
 
 ip = '143.106.72.137'
+freq_units = {"HZ": 1, "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9}
 
 class _basic():
     def _write(self, msg):
@@ -13,11 +15,15 @@ class _basic():
     def _query(self, msg):
         return self.outer.query(msg)
 
-class N9030A:
+    def _set(self, key, value, msg):
+        return self.outer._set(key, value, msg)
+
+class N9030A(scpi_lib.Batching):
     def __init__(self, ip_addr = ip):
         self.rm = visa.ResourceManager()
         self.mode = ""
         self.operation = ""
+        self.cache = {} #settings written since the last preset/resync/mode change (see _set)
 
         self.connect(ip=ip_addr)
         self.preset()
@@ -25,7 +31,7 @@ class N9030A:
         self.rt = self.RTSA(self)
         self.gate = self.Gate(self)
 
-        self.supported_modes = ["SA\n", "RTSA\n"]
+        self.supported_modes = ["SA", "RTSA"]
 
     def connect(self, ip = ip):
         visa_id = "TCPIP::"+ip+"::INSTR"
@@ -37,34 +43,92 @@ class N9030A:
         return self.pxa.query(msg)
 
     def write(self, msg):
+        if self._batched(msg): return
         self.pxa.write(msg)
 
+    def query_binary(self, msg):
+        """ Queries a REAL,32 (little endian) definite length block and returns it as a float32 array. """
+        return self.pxa.query_binary_values(msg, datatype='f', is_big_endian=False, container=np.array)
+
     def preset(self):
         self.write(":SYSTem:PRESet")
+        self.mode = ""
+        self.operation = ""
+        self.cache = {}
+
+    def _set(self, key, value, msg):
+        """ Write-through cache: writes msg only if the cached value of key differs from value.
+        Settings changed on the front panel are only seen after resync().
+        Returns:
+            bool: True if msg was written.
+        """
+        if self.cache.get(key) == value:
+            return False
+        self.write(msg)
+        self.cache[key] = value
+        return True
+
+    def x_axis(self):
+        """ Start and stop frequencies [Hz] as read back from the analyzer (which may round the requested ones),
+        queried once after each frequency change. """
+        if "x_axis" not in self.cache:
+            start, stop = self.query(":FREQuency:STARt?;:FREQuency:STOP?").strip().split(";")
+            self.cache["x_axis"] = (float(start), float(stop))
+        return self.cache["x_axis"]
+
+    def get_mode(self):
+        """ Measurement mode ("SA", "RTSA", ...), queried only if unknown. """
+        if not self.mode:
+            self.mode = self.query(":INSTrument?").strip()
+        return self.mode
+
+    def set_mode(self, mode):
+        """ Changes the measurement mode. Cached settings are dropped, since each mode has its own. """
+        self.write(":INSTrument "+mode)
+        self.mode = mode
+        self.cache = {}
+
+    def resync(self):
+        """ Re-reads the real instrument state into the cache (mode, operation, X axis, trace type and gate).
+        Frequency settings are written again by the next fspan.
+        Returns:
+            dict: cached settings (frequencies in Hz, times in s).
+        """
+        self.cache = {}
+        self.mode = self.query(":INSTrument?").strip()
+        continuous, start, stop, trace_type = self.query(":INITiate:CONTinuous?;:FREQuency:STARt?;"
+                                                         ":FREQuency:STOP?;:TRACe1:TYPE?").strip().split(";")
+        self.operation = "continuous" if int(continuous) else "single"
+        self.cache.update(x_axis = (float(start), float(stop)), trace_type1 = trace_type.strip())
+        if self.mode == "SA":
+            gate, view, gate_time, gate_delay = self.query(":SWEep:EGATe?;:SWEep:EGATe:VIEW?;"
+                            ":SWEep:EGATe:TIME?;:SWEep:EGATe:DELay?").strip().split(";")
+            self.cache.update(gate = bool(int(gate)), gate_view = bool(int(view)),
+                              gate_time = float(gate_time), gate_delay = float(gate_delay))
+        return dict(self.cache, mode = self.mode, operation = self.operation)
 
     def peak_search(self):
         self.write(":CALCulate:MARKer:MAXimum")
 
-    def trace(self):
-        if self.query(":INSTrument?") in self.supported_modes:
-            self.write(':MMEM:STOR:TRAC:DATA TRACE1, "D:\\new.csv"')
-            
-            data = self.query(':MMEM:DATA?  "D:\\new.csv"')
-            
-            self.write(':MMEM:DEL? "D:\\new.csv"')
-
-            num_data = data.split("\r\n")[89:]
+    def trace(self, trace=1):
+        """ Reads a trace as binary REAL,32 data. The X axis spans the start and stop frequencies read back (x_axis).
+        Args:
+            trace (int, optional): Defaults to 1.
+        Returns:
+            tuple: frequencies [Hz], trace values (float32 arrays).
+        """
+        if self.get_mode() in self.supported_modes:
+            self._set("trace_format", "REAL,32", ":FORMat:TRACe:DATA REAL,32;:FORMat:BORDer SWAPped")
 
-            a=np.ones((len(num_data)-1, 2))
-            for ii in range(len(num_data)-1):
-                a[ii, :] = np.fromstring(num_data[ii], dtype=float, sep=",")
+            y = self.query_binary(":TRACe:DATA? TRACE"+str(trace))
+            start, stop = self.x_axis()
 
-            return a[:, 0], a[:, 1]
+            return np.linspace(start, stop, len(y)), y
         else:
             raise Exception("Measurement MODE is not supported. You should implement it.")
     
     def max_hold(self, trace=1):
-            self.write("TRAC"+str(trace)+":TYPE MAXH")
+            self._set("trace_type"+str(trace), "MAXH", "TRAC"+str(trace)+":TYPE MAXH")
 
     def single(self):
         if self.operation != "single":
@@ -81,40 +145,48 @@ class N9030A:
 
         self.write("INIT")
 
-    def _flatten(self, a):
-        return np.array([item for sublist in a for item in sublist])
-
     class SA (_basic):
         def __init__(self, outer):
             self.outer = outer
 
         def config(self):
             print("Configuring Spectrum Analyzer")
-            self._write(":INSTrument SA")
-            self.outer.mode  = "SA"
+            self.outer.set_mode("SA")
 
         def fspan(self, start_freq = None, stop_freq = None, freq_unit = "GHz",
                     bw = None, bw_unit = "KHZ"):
-            if self._query(":INSTrument?")!="SA\n":
+            if self.outer.get_mode()!="SA":
                 self.config()
 
-            if start_freq is not None:
-                self._write(":FREQuency:STARt {:.6f} ".format(start_freq)+freq_unit)
-            
-            if stop_freq is not None:
-                self._write(":FREQuency:STOP {:.6f} ".format(stop_freq)+freq_unit)
-
-            if bw is not None:
-                self._write("SENSe:BANDwidth:RESolution {:.6f} ".format(bw)+bw_unit)
+            #cached as sent, units are passed to the analyzer unchanged
+            try:
+                with self.outer.batch():
+                    if start_freq is not None:
+                        start = "{:.6f} ".format(start_freq)+freq_unit
+                        if self._set("start", start, ":FREQuency:STARt "+start):
+                            self.outer.cache.pop("x_axis", None)
+                    
+                    if stop_freq is not None:
+                        stop = "{:.6f} ".format(stop_freq)+freq_unit
+                        if self._set("stop", stop, ":FREQuency:STOP "+stop):
+                            self.outer.cache.pop("x_axis", None)
+
+                    if bw is not None:
+                        rbw = "{:.6f} ".format(bw)+bw_unit
+                        self._set("rbw", rbw, "SENSe:BANDwidth:RESolution "+rbw)
+            except Exception:
+                #the analyzer state is unknown
+                self.outer.cache = {}
+                raise
 
         def max_hold(self, trace=1):
-            self._write("TRAC"+str(trace)+":TYPE MAXH")
+            self.outer.max_hold(trace=trace)
 
         def wait_hold(self, wait_time, config=True, ask=False, start_freq = None, stop_freq = None, freq_unit = "GHz",
                     bw = None, bw_unit = "KHZ", trace=1):
             if config:
-                if self._query(":INSTrument?")!="SA\n":
-                    print(self._query(":INSTrument?"))
+                if self.outer.get_mode()!="SA":
+                    print(self.outer.get_mode())
                     self.config()
 
                 self.outer.continuous()
@@ -132,46 +204,80 @@ class N9030A:
     class RTSA (_basic):
         def __init__(self, outer):
             self.outer = outer       
-            self.step = None
         
         def config(self):
-            self._write(":INSTrument RTSA")
-            self.outer.mode  = "RTSA"
+            self.outer.set_mode("RTSA")
 
         def fcenter(self, freq, freq_unit = 'GHz'):
             self._write("FREQ:CENT {:.3f}".format(freq)+freq_unit)
+            for key in ("start", "stop", "x_axis"):
+                self.outer.cache.pop(key, None)
 
         def fstep(self, step, step_unit = 'MHz'):
-            if self.step != str(step) + step_unit:
-                self._write("FREQ:CENT:STEP {:.3f}".format(step)+step_unit)
-                self.step = str(step) + step_unit
-                print("Step")
+            self._set("center_step", str(step) + step_unit, "FREQ:CENT:STEP {:.3f}".format(step)+step_unit)
 
             self._write("FREQ:CENT UP")
-
-        def stitching(self, freq_lst, acqtime, freq_unit='GHz', max_hold = True):
-            
-            if self._query(":INSTrument?")!="RTSA\n":
+            for key in ("start", "stop", "x_axis"):
+                self.outer.cache.pop(key, None)
+
+        def stitching(self, freq_lst, acqtime, freq_unit='GHz', max_hold = True, merge = "max"):
+            """ Acquires one segment at each center frequency and stitches them on a common grid.
+            While a segment is merged, the analyzer is already acquiring the next one.
+
+            Args:
+                freq_lst (list): center frequencies.
+                acqtime (float): acquisition time of each segment [s].
+                freq_unit (str, optional): unit of freq_lst. Defaults to 'GHz'.
+                max_hold (bool, optional): If true sets the trace type to max hold. Defaults to True.
+                merge (str, optional): where segments overlap keep the "max" or the "average". Defaults to "max".
+
+            Returns:
+                tuple: frequencies [Hz] (grid with the resolution of one segment, from the lowest to the highest
+                       frequency acquired), stitched trace (NaN where no segment covers the grid).
+            """
+            if merge not in ("max", "average"):
+                raise ValueError('RTSA stitching: merge must be "max" or "average".')
+            if self.outer.get_mode()!="RTSA":
                 self.config()
 
             self.outer.continuous()
             
-            if max_hold: self._write(":TRAC:TYPE MAXH")
-
-            xlist=[]
-            ylist=[]
-            for freq in freq_lst:
-                self.fcenter(freq)
-                time.sleep(acqtime)
-                x,y = self.outer.trace()
-                xlist.append(x)
-                ylist.append(y)
-
-            xflat =self.outer._flatten(xlist)
-            yflat =  self.outer._flatten(ylist)
-            idx = np.argsort(xflat)
-
-            return xflat[idx], yflat[idx]
+            if max_hold: self.outer.max_hold()
+
+            centers = freq_units[freq_unit.upper()]*np.asarray(freq_lst, dtype=float)
+            grid = None
+            self.fcenter(freq_lst[0], freq_unit)
+            t_ready = time.time() + acqtime
+            for ii in range(len(freq_lst)):
+                time.sleep(max(0, t_ready - time.time()))
+                x, y = self.outer.trace()
+
+                #next acquisition runs while this segment is merged
+                if ii+1 < len(freq_lst):
+                    self.fcenter(freq_lst[ii+1], freq_unit)
+                    t_ready = time.time() + acqtime
+
+                if grid is None:
+                    df = (x[-1] - x[0])/(len(x) - 1)
+                    x0, x1 = x[0] + centers.min() - centers[0], x[-1] + centers.max() - centers[0]
+                    grid = np.linspace(x0, x1, int(round((x1 - x0)/df)) + 1)
+                    y_grid = np.full(len(grid), -np.inf if merge == "max" else 0.0)
+                    count = np.zeros(len(grid), dtype=int)
+
+                i0, i1 = np.searchsorted(grid, [x[0], x[-1]], side="left")
+                i1 = min(i1 + 1, len(grid))
+                y_seg = np.interp(grid[i0:i1], x, y, left=np.nan, right=np.nan)
+                valid = ~np.isnan(y_seg)
+                if merge == "max":
+                    y_grid[i0:i1][valid] = np.maximum(y_grid[i0:i1][valid], y_seg[valid])
+                else:
+                    y_grid[i0:i1][valid] += y_seg[valid]
+                count[i0:i1] += valid
+
+            if merge == "average":
+                y_grid[count > 0] /= count[count > 0]
+            y_grid[count == 0] = np.nan
+            return grid, y_grid
   
     class Gate (_basic):
         def __init__(self, outer):
@@ -180,35 +286,29 @@ class N9030A:
 
         def setup(self, gate_time, gate_delay = None, freq_unit = 'GHz'):
             "Setting up Gated Measurement"
-            if self._query(":INSTrument?")!="SA\n":
+            if self.outer.get_mode()!="SA":
                 self.outer.sa.config()
             #self._write("FREQ:CENT {:.3f}".format(freq)+freq_unit)
-            self._write(":SWEep:EGATe ON")
-            self._write("SWEep:EGATe:VIEW ON")
-            self._write("SWEep:EGATe:TIME " + str(gate_time))
+            self._set("gate", True, ":SWEep:EGATe ON")
+            self._set("gate_view", True, "SWEep:EGATe:VIEW ON")
+            self._set("gate_time", float(gate_time), "SWEep:EGATe:TIME " + str(gate_time))
             if gate_delay is not None:
-                self._write("SWEep:EGATe:DELay " + str(gate_delay))
+                self._set_delay(gate_delay)
+
+        def _set_delay(self, gate_delay):
+            self._set("gate_delay", float(gate_delay), "SWEep:EGATe:DELay " + str(gate_delay))
 
         def fspan(self, start_freq = None, stop_freq = None, freq_unit = "GHz",
                     bw = None, bw_unit = "KHZ"):
-            if self._query(":INSTrument?")!="SA\n":
-                self.config()
-
-            if start_freq is not None:
-                self._write(":FREQuency:STARt {:.6f} ".format(start_freq)+freq_unit)
-            
-            if stop_freq is not None:
-                self._write(":FREQuency:STOP {:.6f} ".format(stop_freq)+freq_unit)
-
-            if bw is not None:
-                self._write("SENSe:BANDwidth:RESolution {:.6f} ".format(bw)+bw_unit)
+            self.outer.sa.fspan(start_freq = start_freq, stop_freq = stop_freq, freq_unit = freq_unit,
+                                bw = bw, bw_unit = bw_unit)
         
         def span_meas(self):
-            self._write("SWEep:EGATe:VIEW OFF")
+            self._set("gate_view", False, "SWEep:EGATe:VIEW OFF")
             return self.outer.trace()
 
         def off(self):
-            self._write(":SWEep:EGATe OFF")
+            self._set("gate", False, ":SWEep:EGATe OFF")
 
         #Gate
         def search_delay(self, step=0.2):
@@ -216,15 +316,15 @@ class N9030A:
                 input_ = input("Input gate delay in ms, or + for next step or - for previous. To stop type enter.")
                 delay = 1e3*float(self._query("SWEep:EGATe:DELay?"))
                 if input_ =='+':
-                    self._write("SWEep:EGATe:DELay "+str(1e-3*(delay+step)))
+                    self._set_delay(1e-3*(delay+step))
                     print("Step Forward")
                 elif input_ =='-':
-                    self._write("SWEep:EGATe:DELay "+str(1e-3*(delay-step)))
+                    self._set_delay(1e-3*(delay-step))
                     print("Step Backwards")
                 else:              
                     try:
                         delay = float(input_)
-                        self._write("SWEep:EGATe:DELay "+str(1e-3*(delay)))
+                        self._set_delay(1e-3*(delay))
                         print("Delay", input_)
                     except ValueError:
                         break
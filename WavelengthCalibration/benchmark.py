@@ -0,0 +1,238 @@
+"""Benchmarks of the wavelength calibration pipeline on synthetic C-band sweeps.
+
+A synthetic scope capture has the same columns as our C-band sweeps
+('time', 'cav', 'mzi', 'hcn', 'reflec'): an MZI fringe with the FSR of
+wavelength_calibration.mzi_coefficients, HCN absorption lines placed from
+hcn_nist.csv, cavity dips and gaussian noise. Every stage of the pipeline
+is timed and its peak (python/numpy) memory is traced with tracemalloc.
+
+Example (from this directory):
+-------
+python benchmark.py                      # 1M and 10M points
+python benchmark.py -n 1e6 5e6 50e6 --stream
+python benchmark.py -n 1e5 --peakdet      # checks wc.peakdet (and pyLPD.MLtools.peakdet, if installed)
+
+import benchmark
+data = benchmark.synthetic_sweep(1_000_000)
+results = benchmark.run(data)
+"""
+
+#%%
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from matplotlib import pyplot as plt
+from scipy import constants
+
+import wavelength_calibration as wc
+import numeric_lib
+
+π = constants.pi
+c = constants.c
+
+
+def synthetic_sweep(n_points, lbd_ini = 1527, lbd_end = 1564, time_frame = 7.4,
+                    line_width = 0.004, line_depth = 0.6, n_dips = 300, dip_width = 0.0005,
+                    noise = 0.01, nist_path = None, seed = 0):
+    """Generates a synthetic scope capture of a wavelength sweep (increasing wavelength in time).
+
+    Args:
+        n_points (int): number of points.
+        lbd_ini (float, optional): initial wavelength [nm]. Defaults to 1527.
+        lbd_end (float, optional): final wavelength [nm]. Defaults to 1564.
+        time_frame (float, optional): duration of the capture [s]. Defaults to 7.4 (5 nm/s).
+        line_width (float, optional): HWHM of the HCN lines [nm]. Defaults to 0.004.
+        line_depth (float, optional): depth of the HCN lines (normalized). Defaults to 0.6.
+        n_dips (int, optional): number of cavity resonances. Defaults to 300.
+        dip_width (float, optional): HWHM of the cavity resonances [nm]. Defaults to 0.0005.
+        noise (float, optional): standard deviation of the noise (normalized). Defaults to 0.01.
+        nist_path (str, optional): reference lines. Defaults to wc.param['nist_path'].
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dataframe: columns 'time', 'cav', 'mzi', 'hcn', 'reflec'.
+    """
+    if nist_path is None: nist_path = wc.param['nist_path']
+    rng = np.random.default_rng(seed)
+    n_points = int(n_points)
+
+    t = np.linspace(0, time_frame, n_points)
+    lbd = np.linspace(lbd_ini, lbd_end, n_points)
+
+    # MZI fringe: phase increases by 2π every FSR (D1 in THz)
+    freq = 1e-3*c/lbd
+    fsr = wc.mzi_coefficients(0.5*(lbd_ini+lbd_end))[0]
+    mzi = 0.5 + 0.4*np.cos(2*π*(freq-freq[0])/fsr)
+    del freq
+    mzi += noise*rng.standard_normal(n_points)
+
+    # HCN lines (lorentzian), only evaluated around each line
+    lines = wc.load_reference(nist_path).freq
+    lines = 1e-3*c/lines
+    hcn = np.ones(n_points)
+    _add_dips(hcn, lbd, lines[(lines > lbd_ini) & (lines < lbd_end)], line_width, line_depth)
+    hcn += noise*rng.standard_normal(n_points)
+
+    # cavity resonances
+    cav = np.ones(n_points)
+    dips = rng.uniform(lbd_ini, lbd_end, n_dips)
+    _add_dips(cav, lbd, dips, dip_width, rng.uniform(0.1, 0.9, n_dips))
+    cav += noise*rng.standard_normal(n_points)
+    reflec = 1 - cav + noise*rng.standard_normal(n_points)
+    del lbd
+
+    return pd.DataFrame({'time': t, 'cav': cav, 'mzi': mzi, 'hcn': hcn, 'reflec': reflec})
+
+def _add_dips(y, lbd, centers, width, depth, n_widths = 50):
+    """Subtracts lorentzian dips from y in place (lbd must be sorted)."""
+    depth = np.broadcast_to(depth, np.shape(centers))
+    for center, d in zip(centers, depth):
+        i0, i1 = np.searchsorted(lbd, [center-n_widths*width, center+n_widths*width])
+        y[i0:i1] -= d/(1+((lbd[i0:i1]-center)/width)**2)
+
+def measure(func, *args, **kwargs):
+    """Runs func and returns (output, wall time [s], peak traced memory [MB])."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    try:
+        output = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]/2**20
+        tracemalloc.stop()
+    return output, elapsed, peak
+
+def run(data, stream = False, out_dir = None):
+    """Times each stage of the calibration pipeline on data.
+
+    Args:
+        data (dataframe): synthetic (or real) capture.
+        stream (bool, optional): If true also benchmarks auto_calibrate_stream. Defaults to False.
+        out_dir (str, optional): directory for output files. Defaults to a temporary directory.
+
+    Returns:
+        dict: {stage: (wall time [s], peak memory [MB])}.
+    """
+    plot_steps_bool, cache_bool = wc.param['plot_steps_bool'], wc.param['cache_bool']
+    wc.param['plot_steps_bool'] = False
+    wc.param['cache_bool'] = False
+    tmp_dir = None
+    if out_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        out_dir = tmp_dir.name
+    base_name = os.path.join(out_dir, 'benchmark')
+
+    results = {}
+    try:
+        nist = wc.load_reference()
+        data_raw = wc.reverse(data)
+
+        data_raw, *results['cav_treat'] = measure(wc.cav_treat, data_raw)
+        data_raw, *results['mzi_treat'] = measure(wc.mzi_treat, data_raw)
+        ind_peaks_mzi, *results['mzi_peaks'] = measure(wc.mzi_peaks, data_raw)
+        (ind_min_hcn, mintab_hcn), *results['hcn_peaks'] = measure(wc.hcn_peaks, data_raw)
+        _, *results['optimize_reference'] = measure(wc.optimize_reference, data_raw, ind_min_hcn, mintab_hcn,
+                                                     ind_peaks_mzi, nist, False, base_name)
+        plt.close('all')
+        del data_raw
+
+        _, *results['auto_calibrate'] = measure(wc.auto_calibrate, data, base_name)
+        plt.close('all')
+
+        if stream:
+            fname = base_name+'_raw.parq'
+            data.to_parquet(fname, row_group_size = wc.param['stream_chunk_size'])
+            _, *results['auto_calibrate_stream'] = measure(wc.auto_calibrate_stream, fname, base_name+'_stream')
+    finally:
+        wc.param['plot_steps_bool'], wc.param['cache_bool'] = plot_steps_bool, cache_bool
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    return results
+
+def check_peakdet(data, delta = None, n_random = 1000, seed = 0):
+    """Runs numeric_lib.check_peakdet (fixed cases and random signals), then checks wc.peakdet against
+    numeric_lib.peakdet_reference on the 'mzi' and 'hcn' columns of data. If pyLPD is installed,
+    peakdet_reference is also checked against pyLPD.MLtools.peakdet (where pyLPD does not fail for
+    lack of maxima or minima) and both detectors are timed.
+
+    Args:
+        data (dataframe): synthetic (or real) capture.
+        delta (float, optional): peakdet delta for the data columns. Defaults to wc.param['mzi_peakdet_delta'].
+        n_random (int, optional): number of random signals. Defaults to 1000.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: {'pyLPD': wall time [s] (if installed), 'wc': wall time [s]}.
+
+    Raises:
+        AssertionError: if the outputs differ.
+    """
+    try:
+        import pyLPD.MLtools as mlt
+    except ImportError:
+        mlt = None
+    if delta is None: delta = wc.param['mzi_peakdet_delta']
+
+    def _compare_pyLPD(v, d, label):
+        expected = numeric_lib.peakdet_reference(v, d)
+        if mlt is not None and len(expected[0]) and len(expected[2]):
+            for a, b in zip(mlt.peakdet(v, d), expected):
+                assert np.array_equal(a, b), 'peakdet_reference differs from pyLPD on '+label
+
+    numeric_lib.check_peakdet(n_random, seed, callback = _compare_pyLPD)
+    for column in ['hcn', 'mzi']:
+        numeric_lib.compare_peakdet(data[column].values, delta, "'"+column+"'")
+        _compare_pyLPD(data[column].values, delta, "'"+column+"'")
+
+    timing = {}
+    for label, func in [('pyLPD', None if mlt is None else mlt.peakdet), ('wc', wc.peakdet)]:
+        if func is None:
+            continue
+        t0 = time.perf_counter()
+        func(data.mzi.values, delta)
+        timing[label] = time.perf_counter() - t0
+    return timing
+
+def report(n_points, results):
+    print('\n{:,} points'.format(n_points))
+    print('{:<24}{:>12}{:>16}'.format('stage', 'time [s]', 'peak mem [MB]'))
+    for stage, (elapsed, peak) in results.items():
+        print('{:<24}{:>12.3f}{:>16.1f}'.format(stage, elapsed, peak))
+
+#%%
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description = "Benchmarks the wavelength calibration pipeline on synthetic sweeps.")
+    parser.add_argument('-n', '--points', type = float, nargs = '+', default = [1e6, 1e7],
+                        help = "number of points of each synthetic sweep")
+    parser.add_argument('--stream', action = 'store_true', help = "also benchmark auto_calibrate_stream")
+    parser.add_argument('--peakdet', action = 'store_true', help = "check and time peakdet against pyLPD instead")
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    plt.switch_backend('Agg')
+    for n_points in args.points:
+        data = synthetic_sweep(int(n_points), seed = args.seed)
+        if args.peakdet:
+            timing = check_peakdet(data, seed = args.seed)
+            if 'pyLPD' in timing:
+                print('\n{:,} points: peakdet matches pyLPD, {:.3f} s vs {:.3f} s ({:.1f}x)'.format(
+                    int(n_points), timing['wc'], timing['pyLPD'], timing['pyLPD']/timing['wc']))
+            else:
+                print('\n{:,} points: peakdet matches peakdet_reference, {:.3f} s'.format(int(n_points), timing['wc']))
+            continue
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                results = run(data, stream = args.stream)
+            finally:
+                sys.stdout = stdout
+        report(int(n_points), results)
+        del data
@@ -3,10 +3,10 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 import pandas as pd
 import numpy as np
 import pyLPD.MLtools as mlt
+import os
 import sys
-equip_control_path = 'C:/Users/lpd/Documents/Leticia/DFS/EquipmentControl'
-sys.path.insert(1, equip_control_path)
-import WavelengthCalibration.wavelength_calibration as wc
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)))
+import wavelength_calibration as wc #same module object as in scripts run from this directory
 
 from scipy import constants, interpolate, signal
 c = constants.c
@@ -102,10 +102,8 @@ def freq_shift_correlation(x1, y1, x2, y2, n = None, plot_bool = False):
     span = 0.99*min(np.abs(x1[0]), np.abs(x1[-1]), np.abs(x2[0]), np.abs(x2[-1]))
     x_sample = np.linspace(-span, span, n)[1:-1]
 
-    ifunc1 = interpolate.interp1d(x1, y1)
-    y1_sample = ifunc1(x_sample)
-    ifunc2 = interpolate.interp1d(x2, y2)
-    y2_sample = ifunc2(x_sample)
+    y1_sample = wc.interp_monotone(x_sample, x1, y1)
+    y2_sample = wc.interp_monotone(x_sample, x2, y2)
 
     corr = signal.correlate(np.max(y2_sample)-y2_sample,np.max(y2_sample)-y1_sample, mode='same')
     imatch = np.argmax(corr)
@@ -143,7 +141,7 @@ def pxa_peaks(x, y, thshd, fig, ax, xintervals, yinterval = [-70, -10], d = .015
     y=y[mask]
 
     y_s = mlt.savitzky_golay(y, window_size = window_size_sg, order = 1)
-    posmax, maxtab, posmin, mintab= mlt.peakdet(y_s,peakdet_delta)
+    posmax, maxtab, posmin, mintab= wc.peakdet(y_s,peakdet_delta)
 
     Ω = x[posmax]
     PΩ = y[posmax]
@@ -48,10 +48,30 @@ wc.mzi_treat(data_raw)
 wc.mzi_peaks(data_raw)
 wc.hcn_peaks(data_raw)
 
+
+Example 3 - Other wavelength references:
+-------
+import wavelength_calibration as wc
+
+# 'hcn' (default) and 'c2h2' (or 'acetylene') tables come with this module
+data_calibrated = wc.auto_calibrate(data_raw, 'path_for_saving_calibrated_data', reference='c2h2')
+
+# user tables must have R/P branch columns (as hcn_nist.csv) or a 'wavelength(nm)' column
+wc.register_reference('co', 'path/to/co_lines.csv')
+data_calibrated = wc.auto_calibrate(data_raw, 'path_for_saving_calibrated_data', reference='co')
+
+
+Example 4 - Captures larger than RAM:
+-------
+import wavelength_calibration as wc
+
+# reads the parquet file by chunks (param['stream_chunk_size'] rows) and writes
+# 'path_for_saving_calibrated_data_Processed.parq' incrementally (no plot is shown)
+wc.auto_calibrate_stream('some_experiment.parq', 'path_for_saving_calibrated_data')
+
 Raises:
 --------
     NistFileNotFound: Raises error if reference file cannot be loded (probaly because it is not in the same directory).
-        (TODO: Embed possibility of using acetylen reference and make it easy for the end-user.)
     NistIncorrectKeys: Raised if nist file does not contain the correct column keys.
     CalibrationUnsuccessful: Raises error if it couldn't optimize the reference wavelength to minimize errors when comparing the other HCN peaks.
     DataIncorrectKeys: Raises error if data does not contain correct colums keys.
@@ -59,15 +79,24 @@ Raises:
 
 #%%
 import os
+import glob
+import json
+import hashlib
+import argparse
+import functools
 import itertools
 import sys
+import time
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import pyLPD.MLtools as mlt
 
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))) #EquipmentControl, for numeric_lib
+from numeric_lib import interp_monotone, peakdet
+
 from matplotlib import pyplot as plt
-from sympy import symbols, sqrt, diff, lambdify
-from scipy import constants, interpolate, signal, optimize
+from scipy import constants, signal
 from itertools import chain
 
 π = constants.pi
@@ -76,6 +105,13 @@ c = constants.c
 nist_file = 'hcn_nist.csv'
 nist_dir = os.path.dirname(os.path.realpath(__file__))
 
+#wavelength references available by name (see register_reference)
+references = {
+    'hcn': os.path.join(nist_dir, 'hcn_nist.csv'),
+    'c2h2': os.path.join(nist_dir, 'acetylene_nist.csv'),
+    'acetylene': os.path.join(nist_dir, 'acetylene_nist.csv'),
+}
+
 
 param = {
     'nist_path' : os.path.join(nist_dir, nist_file),
@@ -84,6 +120,7 @@ param = {
     'mzi_fiber_length': 1.49e-3, #in km
     'mzi_envPeak_delta': 0.01,
     'mzi_envPeak_sg': 1,
+    'mzi_envPeak_smooth': 0.1,
     'mzi_savitz_window': 7,
     'mzi_savitz_order': 2,
     'mzi_peakdet_delta': 0.3,
@@ -93,9 +130,22 @@ param = {
     'cav_envPeak_sg': 1,
 
     'plot_steps_bool': False,
-    'err_tshd': 0.01 #(in THz) default threshold of maximum calibration error
+    'err_tshd': 0.01, #(in THz) default threshold of maximum calibration error
+
+    'stream_chunk_size': 2**21, #rows per chunk in auto_calibrate_stream
+    'stream_overlap': 2**16, #rows shared by neighbouring chunks (must cover an hcn line)
+
+    'batch_pattern': '*_C-BandSweep.parq', #files picked up by batch_calibrate in a directory
+
+    'cache_bool': False, #reuse peaks and frequency ruler of previous auto_calibrate runs (see auto_calibrate)
+    'cache_dir': None, #None: '.calibration_cache' in the directory of the output files
 }
 
+#param entries that change the cached peaks and frequency ruler
+cache_param_keys = ['hcn_peakdet_delta', 'cav_envPeak_delta', 'cav_envPeak_smooth', 'cav_envPeak_sg',
+                    'mzi_fiber_length', 'mzi_envPeak_delta', 'mzi_envPeak_sg', 'mzi_envPeak_smooth',
+                    'mzi_savitz_window', 'mzi_savitz_order', 'mzi_peakdet_delta', 'err_tshd']
+
 
 class CalibrationUnsuccessful(Exception):
     """Exception raised for errors in the input salary.
@@ -119,7 +169,7 @@ class NistFileNotFound(Exception):
         self.message = message
         super().__init__(self.message)
     def __str__(self):
-        return f'{self.message} Path: \'{self.path}\'. Please make sure that the file is in the same directory of '+__path__ +'\nAlternatively (not recommended) update file path on param[\'nist_path\']'
+        return f'{self.message} Path: \'{self.path}\'. Please make sure that the file is in the same directory of '+nist_dir +'\nAlternatively, register it with register_reference(name, path) or update file path on param[\'nist_path\']'
 
 class NistIncorrectKeys(Exception):
     def __init__(self, expected, given, message = "Nist Wavelength Reference file has incorrect data or incorrect keys."):
@@ -140,20 +190,164 @@ class DataIncorrectKeys(Exception):
         return f'{self.message}\nExpected {self.expected}\nReceived {self.given}'
 
 
+def envelope(y, delta, smooth = 0, sg_order = 1, max_points = 2**14, block_size = 2**20):
+    """Lower and upper envelopes of y (replaces pyLPD.MLtools.envPeak).
+
+    Local extrema are found with peakdet (delta relative to the full range of y) and linearly
+    interpolated with np.interp. If smooth > 0, the envelopes are smoothed with a savitzky golay
+    filter whose window is the fraction smooth of the record, and maxima below (minima above)
+    the equally smoothed signal are discarded as noise. The filter runs on block averages of at
+    most max_points points and is interpolated back, so its cost does not depend on the window.
+
+    Args:
+        y (array): signal.
+        delta (float): peakdet delta, as a fraction of max(y)-min(y).
+        smooth (float, optional): savitzky golay window as a fraction of len(y). Defaults to 0 (no smoothing).
+        sg_order (int, optional): savitzky golay order. Defaults to 1.
+        max_points (int, optional): maximum number of points of the smoothing filter.
+        block_size (int, optional): points interpolated at a time.
+
+    Returns:
+        [array, array, array, array]: lower envelope, upper envelope, indexes of maxima, indexes of minima.
+    """
+    y = np.asarray(y, dtype=float)
+    y_min, y_max = y.min(), y.max()
+    ind_max, maxtab, ind_min, mintab = peakdet(y, delta*(y_max-y_min))
+
+    window = int(smooth*len(y))
+    smooth_bool = window > sg_order+1
+    if smooth_bool:
+        centers, y_smooth = _smooth_blocks(y, window, sg_order, max_points)
+        keep = maxtab >= np.interp(ind_max, centers, y_smooth)
+        ind_max, maxtab = ind_max[keep], maxtab[keep]
+        keep = mintab <= np.interp(ind_min, centers, y_smooth)
+        ind_min, mintab = ind_min[keep], mintab[keep]
+    if len(ind_max) == 0: ind_max, maxtab = np.array([np.argmax(y)]), np.array([y_max])
+    if len(ind_min) == 0: ind_min, mintab = np.array([np.argmin(y)]), np.array([y_min])
+
+    envelopes = []
+    for ind, tab in [(ind_min, mintab), (ind_max, maxtab)]:
+        env = _interp_range(ind, tab, np.empty(len(y)), block_size)
+        if smooth_bool:
+            env = _interp_range(*_smooth_blocks(env, window, sg_order, max_points), env, block_size)
+        envelopes.append(env)
+
+    return envelopes[0], envelopes[1], ind_max, ind_min
+
+def _interp_range(xp, fp, out, block_size = 2**20):
+    """np.interp of (xp, fp) at 0, 1, ..., len(out)-1, written into out block by block."""
+    for ii in range(0, len(out), block_size):
+        out[ii:ii+block_size] = np.interp(np.arange(ii, min(ii+block_size, len(out))), xp, fp)
+    return out
+
+def _smooth_blocks(y, window, sg_order, max_points):
+    """Savitzky golay filter (window in points of y) applied to at most max_points block averages of y.
+
+    Returns:
+        [array, array]: centers of the blocks (indexes of y), filtered block averages.
+    """
+    stride = -(-len(y)//max_points)
+    edges = np.arange(0, len(y), stride)
+    ends = np.r_[edges[1:], len(y)]
+    blocks = np.add.reduceat(y, edges)/(ends-edges)
+    centers = 0.5*(edges+ends-1)
+
+    window = min(window//stride, len(blocks))
+    window -= 1 - window%2
+    if window > sg_order:
+        blocks = signal.savgol_filter(blocks, window, sg_order, mode='interp')
+    return centers, blocks
+
 def load_nist(nist_path):
+    """Loads a table of reference wavelengths. It should either have R and P branch
+    columns (as 'hcn_nist.csv') or a single 'wavelength(nm)' column."""
     try:
-        nist= pd.read_csv(nist_path,sep=',')
+        nist= pd.read_csv(nist_path,sep=',', skipinitialspace=True)
         print("Successfully loaded wavelength reference file "+nist_path)
     except:
         raise NistFileNotFound(nist_path)
+    nist.columns = nist.columns.str.strip()
     
     handles =['R Branch','R-wavelength(nm)','P Branch','P-wavelength(nm)']
+    if 'wavelength(nm)' in nist.keys():
+        return nist
     for key in handles:
         if key not in nist.keys():
-            raise NistIncorrectKeys(handles, nist.keys())
+            raise NistIncorrectKeys([handles, ['wavelength(nm)']], nist.keys())
 
     return nist
 
+def _is_branch_table(nist):
+    return 'R-wavelength(nm)' in nist.keys()
+
+def register_reference(name, nist_path):
+    """Makes a table of reference wavelengths available by name (e.g. auto_calibrate(..., reference=name)).
+
+    Args:
+        name (str): reference name, case insensitive.
+        nist_path (str): path of the table (see load_nist).
+    """
+    references[name.lower()] = nist_path
+
+def reference_path(reference):
+    """Path of a registered reference name (e.g. 'hcn', 'c2h2'). Anything else is taken as a path."""
+    return references.get(str(reference).lower(), reference)
+
+class ReferenceLines:
+    """Reference lines of a gas cell, indexed by frequency.
+
+    Attributes:
+        nist (dataframe): table of reference wavelengths.
+        candidates (array): wavelengths (nm) tried as λ0, from the center of the band outwards.
+        freq (array): sorted frequencies (THz) of all lines.
+    """
+    def __init__(self, nist):
+        self.nist = nist
+        self.candidates = reference_candidates(nist)
+        if _is_branch_table(nist):
+            lbd = np.concatenate((nist['R-wavelength(nm)'].values, nist['P-wavelength(nm)'].values))
+        else:
+            lbd = nist['wavelength(nm)'].values
+        lbd = lbd[np.isfinite(lbd) & (lbd > 0)].astype(float)
+        self.freq = np.sort(1e-3*c/lbd)
+
+    def nearest(self, freq):
+        """Nearest line of each frequency (binary search).
+
+        Args:
+            freq (float array): frequencies in THz.
+
+        Returns:
+            (int array, float array): index (in self.freq) of the nearest line and distance to it (THz).
+        """
+        freq = np.asarray(freq)
+        jj = np.clip(np.searchsorted(self.freq, freq), 1, len(self.freq)-1)
+        err_left = np.abs(freq - self.freq[jj-1])
+        err_right = np.abs(freq - self.freq[jj])
+        left = err_left < err_right
+
+        return np.where(left, jj-1, jj), np.where(left, err_left, err_right)
+
+@functools.lru_cache(maxsize=None)
+def _load_reference(nist_path):
+    return ReferenceLines(load_nist(nist_path))
+
+def load_reference(reference = None):
+    """Loads (once) the reference lines of a registered name or of a table path.
+
+    Args:
+        reference (str, optional): name (see references) or path. Defaults to param['nist_path'].
+
+    Returns:
+        ReferenceLines: reference lines.
+    """
+    if reference is None: reference = param['nist_path']
+
+    return _load_reference(os.path.abspath(reference_path(reference)))
+
+def _as_reference(nist):
+    return nist if isinstance(nist, ReferenceLines) else ReferenceLines(nist)
+
     
 def reverse(data):
     data = data[::-1].reset_index().copy()
@@ -175,7 +369,7 @@ def cav_treat(data, envPeak_delta = None, envPeak_smooth = None, envPeak_sg = No
     if envPeak_sg is None: envPeak_sg = param["cav_envPeak_sg"]
 
     #actual function
-    ylower, data['yupper_cav'] = mlt.envPeak(data.cav.values, delta=envPeak_delta,  smooth=envPeak_smooth, sg_order=envPeak_sg)
+    ylower, data['yupper_cav'], ind_max, ind_min = envelope(data.cav.values, delta=envPeak_delta,  smooth=envPeak_smooth, sg_order=envPeak_sg)
     data['cav_n'] = data.cav/(data['yupper_cav'])
 
     return data
@@ -194,6 +388,8 @@ def mzi_dispersion(L = None): # in km
     if L is None: L = param['mzi_fiber_length']
 
     #actual function
+    from sympy import symbols, sqrt, diff
+
     π = constants.pi
     c = constants.c
     B1, B2, B3 = 0.6961663, 0.4079426, 0.8974794
@@ -221,14 +417,58 @@ def mzi_dispersion(L = None): # in km
     
     return x, D1_mzi, D2_mzi, D3_mzi
 
+@functools.lru_cache(maxsize=None)
+def _mzi_dispersion_model(L):
+    """Closed-form (NumPy) version of mzi_dispersion for a given fiber length L (in km)."""
+    B = np.array([0.6961663, 0.4079426, 0.8974794])
+    C2 = np.array([68.4043, 116.2414, 9896.161])**2 # in nm²
+    S0 = 0.082 # 0.082(3) ps/(nm².km)
+    Lamb0 = 1280 # 1280(40) nm
+
+    def model(x):
+        x = np.asarray(x, dtype=float)
+        x2 = x[..., None]**2
+        n = np.sqrt(1 + np.sum(B*x2/(x2-C2), axis=-1))
+        dn = -x/n*np.sum(B*C2/(x2-C2)**2, axis=-1)
+        ng = n - x*dn
+
+        D = S0/4*(x-Lamb0**4/x**3) # in ps/(nm.km)
+
+        β1 = 1e15*(ng/c) # ps/km
+        β2 = -1e3*(x**2/2/π/c)*D # in ps²/km
+        β3 = 1e6*x**3/(2*π*c)**2*(2*D+x*S0) # in ps³/km
+
+        D1_mzi = 1/β1/L # in THz
+        D2_mzi = -(2*π*β2/β1)*(1/β1/L)**2 # in THz
+        D3_mzi = (4*π**2/L**3/β1**5)*(3*β2**2-β1*β3) # in THz
+        return D1_mzi, D2_mzi, D3_mzi
+
+    return model
+
+def mzi_coefficients(λ0, L = None):
+    """Numeric dispersion coefficients of the fiber-based MZI (same model as mzi_dispersion).
+
+    Args:
+        λ0 (float or array): wavelength(s) in nm.
+        L (float, optional): fiber length in kilometers. Defaults to param['mzi_fiber_length'].
+
+    Returns:
+        D1, D2, D3 (float or array): FSR, D2/2pi and D3/2pi of the MZI in THz, evaluated at λ0.
+    """
+    if L is None: L = param['mzi_fiber_length']
+
+    return _mzi_dispersion_model(float(L))(λ0)
+
 def mzi_treat(data, envPeak_delta = None, envPeak_sg = None,
-             savitz_window = None, savitz_order=None, plot_steps_bool = None):
+             savitz_window = None, savitz_order=None, plot_steps_bool = None, envPeak_smooth = None):
     """Normalizes MZI using lower and upper envelopes. It also smooths the MZI signal using a savitz golay filter.
+    The local extrema found for the envelopes are flagged in 'mzi_extremum', where mzi_peaks looks for the MZI peaks.
 
     Args:
         data (dataframe): raw data acquired. Should have 'mzi' key.
         envPeak_delta (float, optional): envPeak parameter.
         envPeak_sg (int, optional): envPeak parameter.
+        envPeak_smooth (float, optional): envPeak parameter.
         savitz_window (int, optional): savitz golay parameter.
         savitz_order (int, optional): savitz golay parameter. 
         plot_steps_bool (bool, optional): If true plots MZI signal and smoothed. Defaults to False.
@@ -236,13 +476,18 @@ def mzi_treat(data, envPeak_delta = None, envPeak_sg = None,
     #setting default values if not given
     if envPeak_delta is None: envPeak_delta = param['mzi_envPeak_delta']
     if envPeak_sg is None: envPeak_sg = param['mzi_envPeak_sg']
+    if envPeak_smooth is None: envPeak_smooth = param['mzi_envPeak_smooth']
     if savitz_window is None: savitz_window = param['mzi_savitz_window']
     if savitz_order is None: savitz_order=param['mzi_savitz_order']
     if plot_steps_bool is None: plot_steps_bool = param['plot_steps_bool']
 
     #actual function
-    ylower_mzi, yupper_mzi = mlt.envPeak(data.mzi.values, delta=envPeak_delta, sg_order=envPeak_sg)# Finding lower and upper envelope
+    ylower_mzi, yupper_mzi, ind_max, ind_min = envelope(data.mzi.values, delta=envPeak_delta, smooth=envPeak_smooth, sg_order=envPeak_sg)# Finding lower and upper envelope
     data['mzi_n'] = (data.mzi-ylower_mzi)/(yupper_mzi-ylower_mzi) # Normalizing data
+    extremum = np.zeros(len(data), dtype=bool)
+    extremum[[0, -1]] = True
+    extremum[ind_max], extremum[ind_min] = True, True
+    data['mzi_extremum'] = extremum
     
     if savitz_window%2==0: savitz_window=savitz_window+1
 
@@ -275,7 +520,12 @@ def mzi_peaks(data, peakdet_delta=None, plot_steps_bool = None):
     if plot_steps_bool is None: plot_steps_bool = param['plot_steps_bool']
 
     #actual function
-    ind_max, maxtab, ind_min, mintab = mlt.peakdet(data.mzi_n.values, delta=peakdet_delta)
+    if 'mzi_extremum' in data.keys():
+        #only the local extrema already found by mzi_treat can be peaks
+        ind = np.flatnonzero(data.mzi_extremum.values)
+        ind_max, maxtab, ind_min, mintab = peakdet(data.mzi_n.values[ind], delta=peakdet_delta, x=ind)
+    else:
+        ind_max, maxtab, ind_min, mintab = peakdet(data.mzi_n.values, delta=peakdet_delta)
     ind_peaks_mzi = np.sort(np.concatenate((ind_min, ind_max), axis=0))
     
     if plot_steps_bool:
@@ -289,6 +539,11 @@ def mzi_peaks(data, peakdet_delta=None, plot_steps_bool = None):
          
     return ind_peaks_mzi
 
+def hcn_normalize(data):
+    """Adds 'hcn_n' entry: the 'hcn' data normalized between 0 and 1."""
+    data['hcn_n'] = (data.hcn - data.hcn.min())/(data.hcn.max() - data.hcn.min())
+    return data
+
 def hcn_peaks(data, peakdet_delta=None):
     """identifies and return peaks in HCN (wavelength reference) data.
 
@@ -304,8 +559,8 @@ def hcn_peaks(data, peakdet_delta=None):
     if peakdet_delta is None: peakdet_delta = param['hcn_peakdet_delta']
 
     #actual function
-    data['hcn_n'] = (data.hcn - data.hcn.min())/(data.hcn.max() - data.hcn.min())
-    ind_max_hcn, maxtab_hcn, ind_min_hcn, mintab_hcn = mlt.peakdet(data.hcn_n.values, peakdet_delta)
+    data = hcn_normalize(data)
+    ind_max_hcn, maxtab_hcn, ind_min_hcn, mintab_hcn = peakdet(data.hcn_n.values, peakdet_delta)
     
     if param['plot_steps_bool']:
         plt.figure(figsize=(21,4))
@@ -341,24 +596,52 @@ def calibration(data, λ0, peak_hcn, ind_min_hcn, ind_peaks_mzi):
         dataframe: copy of data with calibrated frequency for each row.
                     Notice that the data will be trimmed at the first and last mzi peaks.
     """
-    
-    c = constants.c
-    freq0 = 1e-3*c/λ0
-    
-    idx_central = np.argmin(np.abs(ind_min_hcn[peak_hcn] - ind_peaks_mzi))
-    range_vector = (np.arange(len(ind_peaks_mzi)) - idx_central)/2
-    
-    x, D1_mzi, D2_mzi, D3_mzi = mzi_dispersion()
-    D1_mzi = lambdify(x, D1_mzi)(λ0) # FSR for MZI in THz
-    D2_mzi = lambdify(x, D2_mzi)(λ0) # D2/2pi for MZI in THz
-    D3_mzi = lambdify(x, D3_mzi)(λ0) # D3/2pi for MZI in THz
-    
-    freq_r = freq0 + D1_mzi*range_vector + D2_mzi/2*range_vector**2 + D3_mzi/6*range_vector**3
+    return apply_ruler(data, ruler_coefficients(λ0, peak_hcn, ind_min_hcn, ind_peaks_mzi), ind_peaks_mzi)
 
-    freq_ifunc = interpolate.interp1d(data.time[ind_peaks_mzi], freq_r)
+def ruler_coefficients(λ0, peak_hcn, ind_min_hcn, ind_peaks_mzi):
+    """Frequency ruler used by calibration: the 'peak_hcn'-th hcn peak is set at λ0 and
+    each mzi peak (half FSR) is a step of the MZI dispersion polynomial.
+
+    Args:
+        λ0 (float): wavelength reference peak.
+        peak_hcn (int): index of measured hcn peak that will be set as λ0.
+        ind_min_hcn (array): indexes in data of hcn peaks
+        ind_peaks_mzi (array): indexes (in data) of mzi peaks.
+
+    Returns:
+        array: [idx_central, freq0, D1, D2, D3] (frequencies in THz), where idx_central is the
+                mzi peak closest to the reference hcn peak.
+    """
+    idx_central = np.argmin(np.abs(ind_min_hcn[peak_hcn] - np.asarray(ind_peaks_mzi)))
+    D1_mzi, D2_mzi, D3_mzi = mzi_coefficients(λ0) # FSR, D2/2pi and D3/2pi for MZI in THz
+
+    return np.array([idx_central, 1e-3*c/λ0, D1_mzi, D2_mzi, D3_mzi])
+
+def _ruler_values(ruler, n_peaks):
+    """Frequencies (THz) of the n_peaks mzi peaks for the coefficients of ruler_coefficients."""
+    idx_central, freq0, D1_mzi, D2_mzi, D3_mzi = ruler
+    range_vector = (np.arange(n_peaks) - idx_central)/2
+
+    return freq0 + D1_mzi*range_vector + D2_mzi/2*range_vector**2 + D3_mzi/6*range_vector**3
+
+def apply_ruler(data, ruler, ind_peaks_mzi):
+    """Interpolates the frequency ruler over every row of data.
+
+    Args:
+        data (dataframe): data to undergo frequency calibration
+        ruler (array): output of ruler_coefficients.
+        ind_peaks_mzi (array): indexes (in data) of mzi peaks.
+
+    Returns:
+        dataframe: copy of data with calibrated frequency for each row.
+                    Notice that the data will be trimmed at the first and last mzi peaks.
+    """
+    freq_r = _ruler_values(ruler, len(ind_peaks_mzi))
 
     data_i = data.iloc[min(ind_peaks_mzi):max(ind_peaks_mzi),:].copy()
-    data_i['freq'] = freq_ifunc(data_i.time)
+    freq = np.empty(len(data_i))
+    interp_monotone(data_i.time.values, data.time.values[ind_peaks_mzi], freq_r, out = freq)
+    data_i['freq'] = freq
     data_i.reset_index(drop=True, inplace=True)
     
     return data_i
@@ -383,39 +666,46 @@ def freq_ruler(λ0, ind_peaks_mzi):
     idx_central = int(len(ind_peaks_mzi)/2)
     range_vector = (np.arange(len(ind_peaks_mzi)) - idx_central)/2
     
-    x, D1_mzi, D2_mzi, D3_mzi = mzi_dispersion()
-    D1_mzi = lambdify(x, D1_mzi)(λ0) # FSR for MZI in THz
-    D2_mzi = lambdify(x, D2_mzi)(λ0) # D2/2pi for MZI in THz
-    D3_mzi = lambdify(x, D3_mzi)(λ0) # D3/2pi for MZI in THz
+    D1_mzi, D2_mzi, D3_mzi = mzi_coefficients(λ0) # FSR, D2/2pi and D3/2pi for MZI in THz
     
     freq_r = D1_mzi*range_vector + D2_mzi/2*range_vector**2 + D3_mzi/6*range_vector**3
 
-    freq_ifunc = interpolate.interp1d(ind_peaks_mzi, freq_r)
-
-    freq_ruler = freq_ifunc(np.arange(min(ind_peaks_mzi),max(ind_peaks_mzi)))
+    freq_ruler = interp_monotone(np.arange(min(ind_peaks_mzi),max(ind_peaks_mzi)), ind_peaks_mzi, freq_r)
 
     return freq_ruler
 
-def plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool, base_name = "./"):
+def plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool, base_name = "./", ind_start = 0):
     """Plots resulting calibration overlayered by expected peaks of wavelength reference.
 
     Args:
         data_i (dataframe): calibrated data.
         ind_min_hcn (array): indexes in data of hcn peaks
         mintab_hcn (array): y values of hcn peaks
-        nist (dataframe): table of reference wavelengths
+        nist (dataframe or ReferenceLines): table of reference wavelengths
         save_bool (bool): If true will save pdf of calibration plot in path 'base_name'
         base_name (str, optional): Path and root name of output pdf file. Defaults to "./".
+        ind_start (int, optional): index in data of the first row of data_i, i.e. the first mzi peak
+                                   (see apply_ruler). Defaults to 0.
     """
+    #hcn peaks as rows of data_i (peaks outside the mzi peaks are trimmed)
+    ind_min_hcn = np.asarray(ind_min_hcn) - ind_start
+    inside = (ind_min_hcn >= 0) & (ind_min_hcn < len(data_i))
+    ind_min_hcn, mintab_hcn = ind_min_hcn[inside], np.asarray(mintab_hcn)[inside]
+
     plt.figure(figsize=(19,5))
     plt.plot(data_i.freq[:], data_i.hcn_n[:])
     plt.scatter(data_i.freq[ind_min_hcn], mintab_hcn)
     colors = itertools.cycle(['r', 'g', 'm'])
     #----
-    plt.stem(1e-3*c/nist['R-wavelength(nm)'], 1.5*np.ones(len(nist)),
-             'r',markerfmt='o',label='R-branch')
-    plt.stem(1e-3*c/nist['P-wavelength(nm)'], 1.5*np.ones(len(nist)),
-             'b',markerfmt='o',label='P-branch')
+    if isinstance(nist, ReferenceLines): nist = nist.nist
+    if _is_branch_table(nist):
+        plt.stem(1e-3*c/nist['R-wavelength(nm)'], 1.5*np.ones(len(nist)),
+                 'r',markerfmt='o',label='R-branch')
+        plt.stem(1e-3*c/nist['P-wavelength(nm)'], 1.5*np.ones(len(nist)),
+                 'b',markerfmt='o',label='P-branch')
+    else:
+        plt.stem(1e-3*c/nist['wavelength(nm)'], 1.5*np.ones(len(nist)),
+                 'r',markerfmt='o',label='reference')
     #---- Annotations
     ax = plt.gca()
     for ii in range(0,len(ind_min_hcn)):
@@ -423,11 +713,12 @@ def plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool, base_name
                     (data_i.freq[ind_min_hcn[ii]]*1.00002, 0.5),
                     color=next(colors), rotation=90)
     #----
-    for ii in range(0,len(nist)-1):
-        ax.annotate(nist['R Branch'][ii], (1e-3*c/nist['R-wavelength(nm)'][ii], 1.2),
-                    color='r', fontsize=15)
-        ax.annotate(nist['P Branch'][ii], (1e-3*c/nist['P-wavelength(nm)'][ii], 1.2), 
-                    color='b', fontsize=15)
+    if _is_branch_table(nist):
+        for ii in range(0,len(nist)-1):
+            ax.annotate(nist['R Branch'][ii], (1e-3*c/nist['R-wavelength(nm)'][ii], 1.2),
+                        color='r', fontsize=15)
+            ax.annotate(nist['P Branch'][ii], (1e-3*c/nist['P-wavelength(nm)'][ii], 1.2), 
+                        color='b', fontsize=15)
     plt.grid(True)
     plt.legend()
     plt.xlabel('Frequency (THz)')
@@ -439,6 +730,106 @@ def plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool, base_name
     
     plt.show()
 
+def reference_candidates(nist):
+    """Lists the reference wavelengths scanned as λ0, from the center of the band outwards
+    (alternating R and P branches for branch tables).
+
+    Args:
+        nist (dataframe): table of reference wavelengths
+
+    Returns:
+        array: candidate reference wavelengths (nm).
+    """
+    if not _is_branch_table(nist):
+        lbd = nist['wavelength(nm)'].dropna().values.astype(float)
+        return lbd[np.argsort(np.abs(lbd - np.median(lbd)), kind='stable')]
+
+    return np.array(list(chain(*zip(nist['R-wavelength(nm)'].values[::-1], nist['P-wavelength(nm)'].values[:-1]))))
+
+def reference_errors(data, lbd_ref, peak_hcn, ind_min_hcn, ind_peaks_mzi, lines = None):
+    """Evaluates the calibration error of all candidate reference wavelengths at once.
+
+    Instead of calibrating the whole dataframe for every candidate, the frequency ruler
+    is only evaluated at the hcn peaks, as a (candidates x peaks) array. Each calibrated
+    peak is then matched to its nearest reference line with a binary search.
+
+    Args:
+        data (dataframe): data. Should have 'time' key.
+        lbd_ref (float array): candidate reference wavelengths (nm).
+        peak_hcn (int): index of measured hcn peak that will be set as λ0.
+        ind_min_hcn (int array): indexes in data of hcn peaks.
+        ind_peaks_mzi (int array): indexes (in data) of mzi peaks.
+        lines (ReferenceLines, optional): reference lines matched to the calibrated peaks.
+                                            Defaults to the lines in lbd_ref.
+
+    Returns:
+        float array: maximum error (in THz) of the hcn peaks for each candidate in lbd_ref.
+    """
+    ind_min_hcn = np.asarray(ind_min_hcn)
+    ind_peaks_mzi = np.asarray(ind_peaks_mzi)
+
+    idx_central = np.argmin(np.abs(ind_min_hcn[peak_hcn] - ind_peaks_mzi))
+
+    #hcn peaks outside the mzi ruler are trimmed by calibration()
+    ind_min_hcn = ind_min_hcn[(ind_min_hcn >= ind_peaks_mzi.min()) & (ind_min_hcn < ind_peaks_mzi.max())]
+
+    time = data.time.values
+    return _reference_errors(lbd_ref, idx_central, time[ind_peaks_mzi], time[ind_min_hcn], lines)
+
+def _reference_errors(lbd_ref, idx_central, time_mzi, time_hcn, lines = None):
+    """reference_errors core, working only on the times of the mzi and hcn peaks."""
+    lbd_ref = np.asarray(lbd_ref, dtype=float)
+    range_vector = (np.arange(len(time_mzi)) - idx_central)/2
+
+    #fractional position of each hcn peak along the mzi peaks (time may be descending)
+    pos = interp_monotone(time_hcn, time_mzi, np.arange(len(time_mzi)), bounds_error = False)
+    ii = np.clip(np.floor(pos).astype(int), 0, len(time_mzi)-2)
+    w = pos - ii
+
+    D1_mzi, D2_mzi, D3_mzi = (D[:, None] for D in mzi_coefficients(lbd_ref)) # in THz
+
+    def ruler(r):
+        return D1_mzi*r + D2_mzi/2*r**2 + D3_mzi/6*r**3
+
+    freq0 = 1e-3*c/lbd_ref
+    meas_freq = freq0[:, None] + (1-w)*ruler(range_vector[ii]) + w*ruler(range_vector[ii+1])
+
+    #nearest reference line of each calibrated peak
+    if lines is None: lines = ReferenceLines(pd.DataFrame({'wavelength(nm)': lbd_ref}))
+    jj, error = lines.nearest(meas_freq)
+
+    return error.max(axis=1)
+
+def _select_reference(lbd_ref, err_lst, err_tshd):
+    """Returns the first candidate of lbd_ref whose error is under err_tshd."""
+    valid = np.flatnonzero(err_lst<err_tshd)
+    if len(valid)==0:
+        raise CalibrationUnsuccessful(err_tshd)
+
+    jj = valid[0]
+    print('λ0 = {:8.5f} nm, ν0 = {:.5f} THz Max error = {:.3f} THz'.format(lbd_ref[jj], 1e-3*c/lbd_ref[jj], err_lst[jj]))
+    return lbd_ref[jj]
+
+def find_reference(data, ind_min_hcn, ind_peaks_mzi, nist, err_tshd = None):
+    """Chooses the middle hcn data peak and returns the first reference wavelength
+    that calibrates the other hcn peaks within err_tshd (see optimize_reference).
+
+    Raises:
+        CalibrationUnsuccessful: if none of the candidates is within err_tshd.
+
+    Returns:
+        float: reference wavelength λ0 (nm) of the middle hcn peak.
+    """
+    if err_tshd is None: err_tshd = param['err_tshd']
+
+    peak_guess = len(ind_min_hcn)//2
+    lines = _as_reference(nist)
+    lbd_ref = lines.candidates
+    
+    print("Optimizing reference wavelength:")
+    err_lst = reference_errors(data, lbd_ref, peak_guess, ind_min_hcn, ind_peaks_mzi, lines)
+    return _select_reference(lbd_ref, err_lst, err_tshd)
+
 def optimize_reference(data, ind_min_hcn, mintab_hcn, 
                        ind_peaks_mzi, nist, save_bool, base_name,
                        err_tshd = None):
@@ -450,7 +841,7 @@ def optimize_reference(data, ind_min_hcn, mintab_hcn,
         ind_min_hcn (int array): indexes in data of hcn peaks.
         mintab_hcn (float array): y values of hcn peaks
         ind_peaks_mzi (int array): indexes (in data) of mzi peaks.
-        nist (dataframe): table of reference wavelengths
+        nist (dataframe or ReferenceLines): table of reference wavelengths
         save_bool (bool): If true will save pdf of calibration plot in path 'base_name'
         base_name (str, optional): Path and root name of output pdf file. Defaults to "./".
 
@@ -465,28 +856,13 @@ def optimize_reference(data, ind_min_hcn, mintab_hcn,
     if err_tshd is None: err_tshd = param['err_tshd']
     
     #actual function
-    c = constants.c
-
     peak_guess = len(ind_min_hcn)//2
-    lbd_ref = np.array(list(chain(*zip(nist['R-wavelength(nm)'].values[::-1], nist['P-wavelength(nm)'].values[:-1]))))
-    
-    print("Optimizing reference wavelength:")
-    for jj, lbd_guess in enumerate(lbd_ref[:]):
-        data_i = calibration(data, lbd_guess,  peak_guess, ind_min_hcn, ind_peaks_mzi)
-        meas_freq = data_i.freq.values[ind_min_hcn]
-        error_tab = []
-        
-        error_tab = [min(np.abs(f - 1e-3*c/lbd_ref)) for f in meas_freq]
-        max_error = max(error_tab)
-
-        print_ = 'λ0 = {:8.5f} nm, ν0 = {:.5f} THz Max error = {:.3f} THz'.format(lbd_guess, 1e-3*c/lbd_guess, max_error)
-        sys.stdout.write('\r'+print_)
-        sys.stdout.flush()
-        
-        if max_error<err_tshd:      
-            plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool = save_bool, base_name = base_name)
-            return data_i
-    raise CalibrationUnsuccessful(err_tshd)
+    lbd_guess = find_reference(data, ind_min_hcn, ind_peaks_mzi, nist, err_tshd = err_tshd)
+
+    data_i = calibration(data, lbd_guess,  peak_guess, ind_min_hcn, ind_peaks_mzi)
+    plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool = save_bool, base_name = base_name,
+                     ind_start = min(ind_peaks_mzi))
+    return data_i
 
 def test_optimize(data, ind_min_hcn, mintab_hcn, 
                        ind_peaks_mzi, nist, save_bool, base_name,
@@ -499,14 +875,10 @@ def test_optimize(data, ind_min_hcn, mintab_hcn,
         ind_min_hcn (int array): indexes in data of hcn peaks.
         mintab_hcn (float array): y values of hcn peaks
         ind_peaks_mzi (int array): indexes (in data) of mzi peaks.
-        nist (dataframe): table of reference wavelengths
+        nist (dataframe or ReferenceLines): table of reference wavelengths
         save_bool (bool): If true will save pdf of calibration plot in path 'base_name'
         base_name (str, optional): Path and root name of output pdf file. Defaults to "./".
 
-    Raises:
-        CalibrationUnsuccessful: if none of the lbd_guess in lbd_ref engender a calibration 
-        error of other peaks within err_tshd
-
     Returns:
         dataframe: calibrated data.
     """
@@ -514,58 +886,130 @@ def test_optimize(data, ind_min_hcn, mintab_hcn,
     if err_tshd is None: err_tshd = param['err_tshd']
     
     #actual function
-    c = constants.c
-
     peak_guess = len(ind_min_hcn)//2
-    lbd_ref = np.array(list(chain(*zip(nist['R-wavelength(nm)'].values[::-1], nist['P-wavelength(nm)'].values[:-1]))))
-    err_lst = np.zeros_like(lbd_ref)
+    lines = _as_reference(nist)
+    lbd_ref = lines.candidates
     print("Optimizing reference wavelength:")
-    for jj, lbd_guess in enumerate(lbd_ref[:]):
-        data_i = calibration(data, lbd_guess,  peak_guess, ind_min_hcn, ind_peaks_mzi)
-        meas_freq = data_i.freq.values[ind_min_hcn]
-        error_tab = []
-        
-        error_tab = [min(np.abs(f - 1e-3*c/lbd_ref)) for f in meas_freq]
-        max_error = max(error_tab)
-
-        print_ = 'λ0 = {:8.5f} nm, ν0 = {:.5f} THz Max error = {:.3f} THz'.format(lbd_guess, 1e-3*c/lbd_guess, max_error)
-        sys.stdout.write('\r'+print_)
-        sys.stdout.flush()
-        
-        err_lst[jj] = max_error
-        #if max_error<err_tshd:      
-        #    plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool = save_bool, base_name = base_name)
-        #    return data_i
+    err_lst = reference_errors(data, lbd_ref, peak_guess, ind_min_hcn, ind_peaks_mzi, lines)
     
     jj_min = np.argmin(err_lst)
     error = err_lst[jj_min]
     lbd_guess = lbd_ref[jj_min]
     print("\n Error:{:.3f}".format(error))
     data_i = calibration(data, lbd_guess,  peak_guess, ind_min_hcn, ind_peaks_mzi)
-    plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool = save_bool, base_name = base_name)
+    plot_calibration(data_i, ind_min_hcn, mintab_hcn, nist, save_bool = save_bool, base_name = base_name,
+                     ind_start = min(ind_peaks_mzi))
     return data_i
 
-    #raise CalibrationUnsuccessful(err_tshd)
+def calibration_key(data, nist_path, forward_lbd_scan = True):
+    """Cache key of a calibration: hash of the raw data content, of the param entries in
+    cache_param_keys and of the nist reference file.
+
+    Args:
+        data (dataframe): raw data.
+        nist_path (str): path of the reference file.
+        forward_lbd_scan (bool, optional): auto_calibrate parameter. Defaults to True.
+
+    Returns:
+        str: hexadecimal key.
+    """
+    h = hashlib.sha1()
+    for key in sorted(data.keys()):
+        h.update(str(key).encode())
+        h.update(np.ascontiguousarray(data[key].values))
+
+    with open(nist_path, 'rb') as f:
+        h.update(f.read())
+
+    h.update(json.dumps({key: param[key] for key in cache_param_keys}, sort_keys=True).encode())
+    h.update(str(forward_lbd_scan).encode())
+    return h.hexdigest()
+
+def calibration_cache_dir(base_name):
+    """Directory of the calibration cache: param['cache_dir'], or '.calibration_cache' next to base_name."""
+    if param['cache_dir'] is not None:
+        return param['cache_dir']
+    return os.path.join(os.path.dirname(os.path.abspath(base_name)), '.calibration_cache')
+
+def _cache_load(key, cache_dir):
+    try:
+        with np.load(os.path.join(cache_dir, key+'.npz')) as f:
+            return {name: f[name] for name in f.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _cache_save(key, cache_dir, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    #written under a temporary name first, batch_calibrate workers may share the cache
+    tmp_name = os.path.join(cache_dir, '{}.{}.tmp.npz'.format(key, os.getpid()))
+    np.savez(tmp_name, **arrays)
+    os.replace(tmp_name, os.path.join(cache_dir, key+'.npz'))
+
+def auto_calibrate(data_in, base_name, nist_path = None, forward_lbd_scan = True, cache = None, reference = None):
+    """Frequency calibration of raw data: normalizes the signals, finds the mzi and hcn peaks,
+    finds the reference wavelength, plots the result and saves base_name+'_Processed.parq'.
+
+    With cache (off by default), the normalized cavity and smoothed mzi signals, peaks, reference
+    wavelength and frequency ruler are saved in calibration_cache_dir(base_name) ('.calibration_cache'
+    next to the output files, unless param['cache_dir'] is set), one .npz file per calibration_key
+    (about 16 bytes per sample). Repeated calls then skip the signal treatment and the peak search:
+    only the ruler interpolation and the outputs (plot and parquet file) remain. A cached calibration
+    is used only while the key matches: it changes with the raw data content, the param entries in
+    cache_param_keys, the content of the reference file and forward_lbd_scan. Changes to this module's code do not change the key, and
+    nothing is evicted: delete the cache directory to clear it.
+
+    Args:
+        data_in (dataframe): raw data (keys 'time', 'cav', 'mzi', 'hcn', 'reflec').
+        base_name (str): path and root name of the output files.
+        nist_path (str, optional): path of the reference file. Defaults to param['nist_path'].
+        forward_lbd_scan (bool, optional): If true data is reversed. Defaults to True.
+        cache (bool, optional): If true uses the calibration cache. Defaults to param['cache_bool'].
+        reference (str, optional): reference name (e.g. 'hcn', 'c2h2', see register_reference),
+                                    used if nist_path is not given.
 
-def auto_calibrate(data_in, base_name, nist_path = None, forward_lbd_scan = True):
-    if nist_path is None: nist_path = param['nist_path']
-    nist = load_nist(nist_path)
+    Returns:
+        dataframe: calibrated data.
+    """
+    if nist_path is None: nist_path = param['nist_path'] if reference is None else reference_path(reference)
+    if cache is None: cache = param['cache_bool']
+    nist = load_reference(nist_path)
 
     for key in ['cav', 'mzi', 'hcn']:
         if key not in data_in.keys():
             raise DataIncorrectKeys(['cav', 'mzi', 'hcn'] , data_in.keys())
 
+    cached = None
+    if cache:
+        key = calibration_key(data_in, nist_path, forward_lbd_scan)
+        cached = _cache_load(key, calibration_cache_dir(base_name))
+
     if forward_lbd_scan:
         data_raw = data_in[::-1].reset_index().copy()
+    else:
+        data_raw = data_in.copy()
 
-    
-    data_raw = cav_treat(data_raw)
-    data_raw = mzi_treat(data_raw)
-
-    ind_peaks_mzi_ = mzi_peaks(data_raw)
-    ind_min_hcn_, mintab_hcn_ = hcn_peaks(data_raw)
-    data_i = optimize_reference(data_raw, ind_min_hcn_, mintab_hcn_, ind_peaks_mzi_, nist, 
-                    save_bool = True, base_name = base_name)
+    if cached is None:
+        data_raw = cav_treat(data_raw)
+        data_raw = mzi_treat(data_raw)
+        ind_peaks_mzi_ = mzi_peaks(data_raw)
+        ind_min_hcn_, mintab_hcn_ = hcn_peaks(data_raw)
+        λ0 = find_reference(data_raw, ind_min_hcn_, ind_peaks_mzi_, nist)
+        ruler = ruler_coefficients(λ0, len(ind_min_hcn_)//2, ind_min_hcn_, ind_peaks_mzi_)
+        if cache:
+            _cache_save(key, calibration_cache_dir(base_name), ind_peaks_mzi = ind_peaks_mzi_, ind_min_hcn = ind_min_hcn_,
+                        mintab_hcn = mintab_hcn_, lbd0 = λ0, ruler = ruler,
+                        cav_n = data_raw.cav_n.values, mzi_s = data_raw.mzi_s.values)
+    else:
+        print("Using cached calibration (λ0 = {:8.5f} nm)".format(float(cached['lbd0'])))
+        ind_peaks_mzi_, ind_min_hcn_, mintab_hcn_ = cached['ind_peaks_mzi'], cached['ind_min_hcn'], cached['mintab_hcn']
+        ruler = cached['ruler']
+        data_raw['cav_n'], data_raw['mzi_s'] = cached['cav_n'], cached['mzi_s']
+        data_raw = hcn_normalize(data_raw)
+
+    data_i = apply_ruler(data_raw, ruler, ind_peaks_mzi_)
+    plot_calibration(data_i, ind_min_hcn_, mintab_hcn_, nist, save_bool = True, base_name = base_name,
+                     ind_start = min(ind_peaks_mzi_))
     
 
     data = pd.DataFrame()
@@ -580,30 +1024,320 @@ def auto_calibrate(data_in, base_name, nist_path = None, forward_lbd_scan = True
 
     data.to_parquet(base_name+'_Processed.parq', compression='brotli')
     return data
-#%%
-if __name__=='__main__':
-    fname='C:\\Users\\lpd\\Documents\\Leticia\\DFS\\2021-09-02_OpticalTransmission\\2021-09-07-11_OpticalTransmission_BareSphere-238umDiameter_Tunics-Laser-5nms-Pol1_C-Band\\2021-09-07-11-44_Att_in34_C-BandSweep.parq'
-    data_raw = pd.read_parquet(fname)
-    nist = load_nist(param['nist_path'])
-    #try:
-    if False:
-        data_raw = cav_treat(data_raw)
-        data_raw = mzi_treat(data_raw)
 
-        ind_peaks_mzi_ = mzi_peaks(data_raw)
-        ind_min_hcn_, mintab_hcn_ = hcn_peaks(data_raw)
-        data_i = optimize_reference(data_raw, ind_min_hcn_, mintab_hcn_, ind_peaks_mzi_, nist, save_bool = False, base_name = fname[:-5])
-    #except CalibrationUnsuccessful:
-    if False:
-        data_raw = reverse(data_raw)
+def _iter_parquet(pf, columns, chunk_size, reverse = False, tmp_name = None):
+    """Yields dataframes of at most chunk_size rows from a pyarrow ParquetFile.
 
-        ind_peaks_mzi_ = mzi_peaks(data_raw)
-        ind_min_hcn_, mintab_hcn_ = hcn_peaks(data_raw)
-        data_i = optimize_reference(data_raw, ind_min_hcn_, mintab_hcn_, ind_peaks_mzi_, nist, save_bool = False, base_name = fname[:-5])
+    Memory is bounded by chunk_size with pyarrow >= 3 (ParquetFile.iter_batches). Older
+    versions read whole row groups, so memory is bounded by the row group size.
+    If reverse, rows (and chunks) come out in reversed order: the chunks are first written
+    reversed to tmp_name, one row group each, which is then read from its last row group.
+    """
+    if reverse:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in _iter_parquet(pf, columns, chunk_size):
+                table = pa.Table.from_pandas(chunk[::-1], preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_name, table.schema)
+                writer.write_table(table)
+            if writer is None:
+                return
+            writer.close()
+            writer = None
+
+            #file object closed before removal (Windows cannot remove open files)
+            with open(tmp_name, 'rb') as f:
+                pf_rev = pq.ParquetFile(f)
+                for rg in reversed(range(pf_rev.num_row_groups)):
+                    yield pf_rev.read_row_group(rg).to_pandas()
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        return
+
+    if hasattr(pf, 'iter_batches'):
+        for batch in pf.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    for rg in range(pf.num_row_groups):
+        df = pf.read_row_group(rg, columns=columns).to_pandas()
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start+chunk_size].reset_index(drop=True)
+        del df
+
+def _overlapping_windows(chunks, overlap):
+    """Regroups a stream of dataframes into windows sharing 'overlap' rows with their neighbours.
+
+    Yields:
+        (dataframe, int, int, int): window, start and stop of its core (rows that belong to
+                                    this window only) and global index of its first row.
+    """
+    buf = None
+    offset = 0 #global index of buf's first row
+    core_from = 0 #global index of the next core row
+    for chunk in chunks:
+        buf = chunk if buf is None else pd.concat([buf, chunk], ignore_index=True)
+        core_to = offset + len(buf) - overlap
+        if core_to > core_from:
+            yield buf.copy(deep=False), core_from-offset, core_to-offset, offset
+            keep = core_to - overlap - offset
+            if keep > 0:
+                buf = buf.iloc[keep:].reset_index(drop=True)
+                offset += keep
+            core_from = core_to
+
+    if buf is not None and offset+len(buf) > core_from:
+        yield buf, core_from-offset, len(buf), offset
+
+def auto_calibrate_stream(fname, base_name, nist_path = None, forward_lbd_scan = True,
+                          chunk_size = None, overlap = None, reference = None):
+    """Same as auto_calibrate, but streams the parquet file 'fname' by chunks
+    so that memory is bounded by the chunk size, not the record length
+    (by the parquet row group size with pyarrow < 3, see _iter_parquet).
+
+    Envelopes and peaks are computed on overlapping chunks. The treated signals are spilled
+    to a temporary parquet file, which is then calibrated and written to
+    base_name+'_Processed.parq' chunk by chunk. No calibration plot is produced.
 
-    base_name = fname[:-6]
-    auto_calibrate(data_raw, base_name, forward_lbd_scan = True)
+    Args:
+        fname (str): path of the raw parquet file (columns 'time', 'cav', 'mzi', 'hcn', 'reflec').
+        base_name (str): path and root name of the output file.
+        nist_path (str, optional): path of the reference file. Defaults to param['nist_path'].
+        forward_lbd_scan (bool, optional): If true data is reversed. Defaults to True.
+        chunk_size (int, optional): rows per chunk. Defaults to param['stream_chunk_size'].
+        overlap (int, optional): rows shared by neighbouring chunks. Should be larger than an
+                                hcn line and many mzi fringes. Defaults to param['stream_overlap'].
+        reference (str, optional): reference name (e.g. 'hcn', 'c2h2'), used if nist_path is not given.
 
+    Raises:
+        DataIncorrectKeys: if the file does not contain the necessary columns.
+        CalibrationUnsuccessful: if no reference wavelength calibrates within param['err_tshd'].
 
+    Returns:
+        str: path of the calibrated file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if nist_path is None: nist_path = param['nist_path'] if reference is None else reference_path(reference)
+    if chunk_size is None: chunk_size = param['stream_chunk_size']
+    if overlap is None: overlap = param['stream_overlap']
+    nist = load_reference(nist_path)
+
+    pf = pq.ParquetFile(fname)
+    columns = ['time', 'cav', 'mzi', 'hcn', 'reflec']
+    names = pf.schema.to_arrow_schema().names
+    for key in columns:
+        if key not in names:
+            raise DataIncorrectKeys(columns, names)
+
+    #1st pass: hcn normalization
+    hcn_min, hcn_max = np.inf, -np.inf
+    for chunk in _iter_parquet(pf, ['hcn'], chunk_size):
+        hcn_min = min(hcn_min, chunk.hcn.min())
+        hcn_max = max(hcn_max, chunk.hcn.max())
+
+    #2nd pass: envelopes, smoothing and peaks. Treated data goes to a temporary file
+    tmp_name = base_name+'_tmp.parq'
+    rev_name = base_name+'_rev_tmp.parq'
+    ind_peaks_mzi, time_mzi = [], []
+    ind_min_hcn, time_hcn = [], []
+    writer = None
+    print("Treating data by chunks:")
+    try:
+        chunks = _iter_parquet(pf, columns, chunk_size, forward_lbd_scan, rev_name)
+        for win, core_0, core_f, offset in _overlapping_windows(chunks, overlap):
+            #same smoothing window (in points) as in auto_calibrate
+            scale = pf.metadata.num_rows/len(win)
+            win = cav_treat(win, envPeak_smooth=param['cav_envPeak_smooth']*scale)
+            win = mzi_treat(win, plot_steps_bool=False, envPeak_smooth=param['mzi_envPeak_smooth']*scale)
+
+            ind = mzi_peaks(win, plot_steps_bool=False)
+            ind = ind[(ind>=core_0) & (ind<core_f)]
+            ind_peaks_mzi.append(ind+offset)
+            time_mzi.append(win.time.values[ind])
+
+            hcn_n = (win.hcn.values - hcn_min)/(hcn_max - hcn_min)
+            ind_max, maxtab, ind, mintab = peakdet(hcn_n, param['hcn_peakdet_delta'])
+            ind = np.asarray(ind, dtype=int)
+            ind = ind[(ind>=core_0) & (ind<core_f)]
+            ind_min_hcn.append(ind+offset)
+            time_hcn.append(win.time.values[ind])
+
+            core = pd.DataFrame({
+                'time': win.time.values[core_0:core_f],
+                'mzi': win.mzi_s.values[core_0:core_f],
+                'cav': win.cav_n.values[core_0:core_f],
+                'hcn': win.hcn.values[core_0:core_f],
+                'reflec': win.reflec.values[core_0:core_f],
+            })
+            table = pa.Table.from_pandas(core, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_name, table.schema)
+            writer.write_table(table)
+            sys.stdout.write('\r{} rows'.format(offset+core_f))
+            sys.stdout.flush()
+        writer.close()
+        writer = None
+        print()
+
+        ind_peaks_mzi = np.concatenate(ind_peaks_mzi)
+        time_mzi = np.concatenate(time_mzi)
+        ind_min_hcn = np.concatenate(ind_min_hcn)
+        time_hcn = np.concatenate(time_hcn)
+
+        #reference wavelength
+        peak_guess = len(ind_min_hcn)//2
+        idx_central = np.argmin(np.abs(ind_min_hcn[peak_guess] - ind_peaks_mzi))
+        inside = (ind_min_hcn >= ind_peaks_mzi.min()) & (ind_min_hcn < ind_peaks_mzi.max())
+        lbd_ref = nist.candidates
+        print("Optimizing reference wavelength:")
+        err_lst = _reference_errors(lbd_ref, idx_central, time_mzi, time_hcn[inside], nist)
+        λ0 = _select_reference(lbd_ref, err_lst, param['err_tshd'])
+
+        #3rd pass: frequency calibration, trimmed at the first and last mzi peaks
+        ruler = ruler_coefficients(λ0, peak_guess, ind_min_hcn, ind_peaks_mzi)
+        freq_r = _ruler_values(ruler, len(ind_peaks_mzi))
+        row_0, row_f = ind_peaks_mzi.min(), ind_peaks_mzi.max()
+
+        out_name = base_name+'_Processed.parq'
+        offset = 0
+        for chunk in _iter_parquet(pq.ParquetFile(tmp_name), None, chunk_size):
+            start = min(max(row_0-offset, 0), len(chunk))
+            stop = min(max(row_f-offset, 0), len(chunk))
+            offset += len(chunk)
+            if stop <= start:
+                continue
+            chunk = chunk.iloc[start:stop]
+
+            data = pd.DataFrame()
+            data['freq'] = interp_monotone(chunk.time.values, time_mzi, freq_r, out = np.empty(len(chunk)))
+            data['mzi'] = chunk.mzi.values
+            data['cav'] = chunk.cav.values
+            data['hcn'] = chunk.hcn.values
+            data['reflec'] = chunk.reflec.values
+
+            table = pa.Table.from_pandas(data, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out_name, table.schema, compression='brotli')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+        for name in [tmp_name, rev_name]:
+            if os.path.exists(name):
+                os.remove(name)
+
+    print(out_name)
+    return out_name
+
+def batch_files(paths, pattern = None):
+    """Expands directories and glob patterns into the list of raw files to calibrate.
 
-# %%
+    Args:
+        paths (list of str): files, directories or glob patterns.
+        pattern (str, optional): glob used inside directories. Defaults to param['batch_pattern'].
+
+    Returns:
+        list of str: sorted raw file paths ('_Processed.parq' outputs are left out).
+    """
+    if pattern is None: pattern = param['batch_pattern']
+
+    fnames = set()
+    for path in paths:
+        if os.path.isdir(path):
+            fnames.update(glob.glob(os.path.join(path, pattern)))
+        else:
+            fnames.update(glob.glob(path))
+    return sorted(f for f in fnames if not f.endswith('_Processed.parq'))
+
+def _is_up_to_date(fname, base_name):
+    out_name = base_name+'_Processed.parq'
+    return os.path.exists(out_name) and os.path.getmtime(out_name) >= os.path.getmtime(fname)
+
+def _batch_init():
+    #workers never open windows
+    plt.switch_backend('Agg')
+
+def _calibrate_file(fname, param_, force = False, stream = False, forward_lbd_scan = True, reference = None):
+    """Calibrates one file in a batch_calibrate worker. Returns (fname, status, elapsed time)."""
+    param.update(param_)
+    base_name = os.path.splitext(fname)[0]
+    if not force and _is_up_to_date(fname, base_name):
+        return fname, 'skipped', 0
+
+    t0 = time.time()
+    try:
+        if stream:
+            auto_calibrate_stream(fname, base_name, forward_lbd_scan = forward_lbd_scan, reference = reference)
+        else:
+            auto_calibrate(pd.read_parquet(fname), base_name, forward_lbd_scan = forward_lbd_scan, reference = reference)
+        status = 'ok'
+    except CalibrationUnsuccessful as e:
+        status = 'CalibrationUnsuccessful: '+str(e)
+    except Exception as e:
+        status = 'failed: {}: {}'.format(type(e).__name__, e)
+    finally:
+        plt.close('all')
+    return fname, status, time.time()-t0
+
+def batch_calibrate(paths, processes = None, force = False, stream = False,
+                    forward_lbd_scan = True, pattern = None, reference = None):
+    """Calibrates many sweep files in parallel (one file per process), without showing plots.
+
+    Args:
+        paths (str or list of str): files, directories or glob patterns.
+        processes (int, optional): number of worker processes. Defaults to the number of CPUs.
+        force (bool, optional): If true recalibrates files whose '_Processed.parq' output is
+                                newer than the raw file. Defaults to False.
+        stream (bool, optional): If true uses auto_calibrate_stream. Defaults to False.
+        forward_lbd_scan (bool, optional): auto_calibrate parameter. Defaults to True.
+        pattern (str, optional): glob used inside directories. Defaults to param['batch_pattern'].
+        reference (str, optional): reference name (e.g. 'hcn', 'c2h2', or any registered with register_reference)
+                                   or table path. Defaults to param['nist_path'].
+
+    Returns:
+        dict: status of each file ('ok', 'skipped', 'CalibrationUnsuccessful: ...' or 'failed: ...').
+    """
+    if isinstance(paths, str): paths = [paths]
+    fnames = batch_files(paths, pattern = pattern)
+    #workers started with spawn (Windows) only know the default references, not the registered ones
+    if reference is not None: reference = reference_path(reference)
+    print("Calibrating {} files".format(len(fnames)))
+
+    report = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers = processes, initializer = _batch_init) as pool:
+        futures = [pool.submit(_calibrate_file, fname, dict(param), force, stream, forward_lbd_scan, reference)
+                   for fname in fnames]
+        for future in concurrent.futures.as_completed(futures):
+            fname, status, elapsed = future.result()
+            report[fname] = status
+            print('{:7.1f}s  {}  {}'.format(elapsed, os.path.basename(fname), status))
+
+    n_ok = sum(status == 'ok' for status in report.values())
+    n_skip = sum(status == 'skipped' for status in report.values())
+    print("{} calibrated, {} skipped, {} unsuccessful".format(n_ok, n_skip, len(report)-n_ok-n_skip))
+    return report
+
+#%%
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description = "Frequency calibration of C-band sweep files.")
+    parser.add_argument('paths', nargs = '+', help = "files, directories or glob patterns")
+    parser.add_argument('-j', '--processes', type = int, default = None, help = "number of worker processes")
+    parser.add_argument('-f', '--force', action = 'store_true', help = "recalibrate up to date files")
+    parser.add_argument('--stream', action = 'store_true', help = "use auto_calibrate_stream (bounded memory)")
+    parser.add_argument('--backward', action = 'store_true', help = "data is not reversed before calibration")
+    parser.add_argument('--pattern', default = None, help = "glob used inside directories")
+    parser.add_argument('--reference', default = None, help = "wavelength reference name ('hcn', 'c2h2') or table path")
+    args = parser.parse_args()
+
+    report = batch_calibrate(args.paths, processes = args.processes, force = args.force, stream = args.stream,
+                             forward_lbd_scan = not args.backward, pattern = args.pattern, reference = args.reference)
+    sys.exit(any(status not in ('ok', 'skipped') for status in report.values()))
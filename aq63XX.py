@@ -6,11 +6,11 @@
 
 import visa
 import numpy as np
-import struct
 import matplotlib.pyplot as plt
 import time
+import scpi_lib
 
-class AQ63XX:
+class AQ63XX(scpi_lib.Batching):
     #definitions
     gpib = True
     eth = False
@@ -29,9 +29,13 @@ class AQ63XX:
     traceLength = 0
     trace = "tra"
     tracen = 0
+    x_cache = None
+    trace_names = ("tra", "trb", "trc", "trd", "tre", "trf", "trg")
+    srq = True #wait for sweeps with service requests when the interface supports them (GPIB, USB)
     
     #main functions
     def __init__(self):
+        self.x_cache = {}
         try:
             self.visarm = visa.ResourceManager('@ni')
             self.visaOK = True
@@ -51,7 +55,31 @@ class AQ63XX:
         return 0
 
     def write(self, msg):
+        self.ClearXAxis()
+        if self._batched(msg): return
         self.osa.write(msg)
+
+    def query(self, msg):
+        return self.osa.query(msg)
+
+    def ClearXAxis(self):
+        """Forgets the cached X axes. Setters of start/stop/center/span/points and of the X unit
+        call it; call it if these are changed from the front panel."""
+        self.x_cache.clear()
+
+    def GetXAxis(self, length = None, trace = None):
+        """X axis of a trace (defaults to the active trace). It is only queried when not in cache,
+        or when its length differs from length (e.g. number of points of the Y trace just read)."""
+        if trace is None: trace = self.trace
+        data_x = self.x_cache.get(trace)
+        if data_x is None or (length is not None and len(data_x) != length):
+            if self.binary:
+                data_x = np.array(self.osa.query_binary_values("trac:data:x? " + trace, 
+                                                    datatype='f', is_big_endian=False))
+            else:
+                data_x = self.ascii_block(self.osa.query("trac:data:x? " + trace))
+            self.x_cache[trace] = data_x
+        return data_x
     
     #OSA functions
     
@@ -87,6 +115,7 @@ class AQ63XX:
     def InitOSA(self, fullInit=True, print_bool=True, binarymode=True, tracen=0, write=True):
         self.print_bool = print_bool
         if self.osaOK:
+            self.ClearXAxis()
             self.binary = binarymode
             self.tracen = tracen
             if self.binary:
@@ -103,8 +132,7 @@ class AQ63XX:
             self.osa.write(':INITiate:SMODe SINGle')
             self.osa.write(':CALibration:ZERO off')
             self.osa.write(':CALibration:ZERO once')
-            time.sleep(5)
-            #osa.write('*WAI')
+            self.WaitOPC(timeout=10)
             
             self.ChangeTrace(self.tracen, wr=write)
             self.traceLength = self.GetTraceLength()
@@ -131,9 +159,9 @@ class AQ63XX:
 
     def HorizonScale(self, is_wavelength):
         if is_wavelength:
-            self.osa.write(":UNIT:X WAVelength")
+            self.write(":UNIT:X WAVelength")
         else:
-            self.osa.write(":UNIT:X FREQuency")
+            self.write(":UNIT:X FREQuency")
         
     def ContinuousSweep(self):
         if self.osaOK:
@@ -160,6 +188,7 @@ class AQ63XX:
     def SetStartWavelength(self, wl):
         if self.osaOK:
             wl = wl*1e-9
+            self.ClearXAxis()
             self.osa.write("sens:wav:start " + str(wl))
     
     def GetStopWavelength(self):
@@ -173,6 +202,7 @@ class AQ63XX:
     def SetStopWavelength(self, wl):
         if self.osaOK:
             wl = wl*1e-9
+            self.ClearXAxis()
             self.osa.write("sens:wav:stop " + str(wl))
     
     def GetCenterWavelength(self):
@@ -186,6 +216,7 @@ class AQ63XX:
     def SetCenterWavelength(self, wl):
         if self.osaOK:
             wl = wl*1e-9
+            self.ClearXAxis()
             self.osa.write("sens:wav:center " + str(wl))
     
     def GetSpanWavelength(self):
@@ -281,6 +312,7 @@ class AQ63XX:
     
     def SetTraceLength(self, length):
         if self.osaOK:
+            self.ClearXAxis()
             if length == 0:
                 self.osa.write("sens:swe:points:auto on")        
             else:
@@ -330,80 +362,76 @@ class AQ63XX:
         return data_x, data_y
     
     def GetBinTrace(self):
-        counter = 0
-        while counter<100 and self.EndedSweep()==False:
-            time.sleep(.1)
-            #print("Waiting for Acquisition.")
-            counter = counter+1
+        self.WaitSweep(timeout=10)
 
         data_y = self.osa.query_binary_values("trac:data:y? " + self.trace, 
                                         datatype='f', is_big_endian=False)
-        data_x = self.osa.query_binary_values("trac:data:x? " + self.trace, 
-                                        datatype='f', is_big_endian=False)
+        data_x = self.GetXAxis(len(data_y))
         return np.array(data_x), np.array(data_y)
 
     
     def GetASCIITrace(self):
         if self.osaOK:
             print('OSA ok')
-            data_y = self.osa.query("trac:data:y? " + self.trace)
-            stringlist_y = data_y.split(",")
-            numlist_y = []
-
-            data_x = self.osa.query("trac:data:x? " + self.trace)
-            stringlist_x = data_x.split(",")
-            numlist_x = []
-            
-            for i in range(0, len(stringlist_y)):
-                numlist_x.append(float(stringlist_x[i]))
-                numlist_y.append(float(stringlist_y[i]))
-            return numlist_x, numlist_y
+            data_y = self.ascii_block(self.osa.query("trac:data:y? " + self.trace))
+            data_x = self.GetXAxis(len(data_y))
+            return np.array(data_x), data_y
         else:
-            arr = []
-            for i in range(0,self.traceLength):
-                arr[i] = "0"
-            return arr, arr
+            arr = np.zeros(self.traceLength)
+            return arr, arr.copy()
     
     def ChangeTrace(self, tr, wr=True):
         if self.osaOK:
             self.tracen = tr
-            if tr == 0:
-                self.trace = "tra"
-            elif tr == 1:
-                self.trace = "trb"                
-            elif tr == 2:
-                self.trace = "trc"                
-            elif tr == 3:
-                self.trace = "trd"                
-            elif tr == 4:
-                self.trace = "tre"                
-            elif tr == 5:
-                self.trace = "trf"
-            elif tr == 6:
-                self.trace = "trg"
-                
-            self.osa.write("trac:stat:tra fix")
-            self.osa.write("trac:stat:trb fix")
-            self.osa.write("trac:stat:trc fix")
-            self.osa.write("trac:stat:trd fix")
-            self.osa.write("trac:stat:tre fix")
-            self.osa.write("trac:stat:trf fix")
-            self.osa.write("trac:stat:trg fix")
-        
-            self.osa.write("trac:stat:tra off")
-            self.osa.write("trac:stat:trb off")
-            self.osa.write("trac:stat:trc off")
-            self.osa.write("trac:stat:trd off")
-            self.osa.write("trac:stat:tre off")
-            self.osa.write("trac:stat:trf off")
-            self.osa.write("trac:stat:trg off")
-        
-            self.osa.write("trac:act " + self.trace)
-            self.osa.write("trac:stat:" + self.trace + " on")
-    
+            if 0 <= tr < len(self.trace_names):
+                self.trace = self.trace_names[tr]
+
+            #trace state changes are sent in a single message (':' restarts each command at the root)
+            cmds = [":trac:stat:" + name + " fix" for name in self.trace_names]
+            cmds += [":trac:stat:" + name + " off" for name in self.trace_names]
+            cmds += [":trac:act " + self.trace, ":trac:stat:" + self.trace + " on"]
             if wr:
-                self.osa.write("trac:attr:" + self.trace + " write")
-    
+                cmds.append(":trac:attr:" + self.trace + " write")
+            self.osa.write(";".join(cmds))
+
+    def GetTraces(self, traces = None):
+        """Reads several traces (A to G).
+
+        In ASCII mode all Y traces (and the X axes that are not cached, see GetXAxis) are requested
+        in one semicolon-joined message and decoded from the one response. In binary mode each block
+        is read with query_binary_values, which reads the exact length declared in its header (a 0x0A
+        byte of the float data would end a read_raw with the "\r\n" termination of Ethernet sessions).
+
+        Args:
+            traces (list, optional): trace names ('tra' to 'trg') or numbers (0 to 6). Defaults to all traces.
+
+        Returns:
+            dict: {trace name: (x array, y array)}. In binary mode y is a float32 array.
+        """
+        if traces is None: traces = self.trace_names
+        traces = [self.trace_names[tr] if isinstance(tr, int) else tr.lower() for tr in traces]
+        if not self.osaOK:
+            arr = np.zeros(self.traceLength)
+            return {tr: (arr, arr.copy()) for tr in traces}
+
+        self.WaitSweep(timeout=10)
+        queries = [("y", tr) for tr in traces] + [("x", tr) for tr in traces if tr not in self.x_cache]
+        if self.binary:
+            blocks = [self.osa.query_binary_values(":trac:data:" + axis + "? " + tr, datatype='f',
+                                                   is_big_endian=False, container=np.array)
+                      for axis, tr in queries]
+        else:
+            msg = ";".join(":trac:data:" + axis + "? " + tr for axis, tr in queries)
+            blocks = [self.ascii_block(resp) for resp in self.osa.query(msg).split(";")]
+        if len(blocks) != len(queries):
+            raise IOError("Expected {:d} traces from OSA AQ63XX, got {:d}".format(len(queries), len(blocks)))
+
+        data = dict(zip(queries, blocks))
+        for axis, tr in queries:
+            if axis == "x":
+                self.x_cache[tr] = np.array(data[axis, tr], dtype=float)
+        return {tr: (np.array(self.GetXAxis(len(data["y", tr]), trace=tr)), data["y", tr]) for tr in traces}
+
     def EndedSweep(self):
         if self.osaOK:
             resp = self.osa.query(":stat:oper:cond?")
@@ -411,22 +439,108 @@ class AQ63XX:
             return ended
         else:
             return True
+
+    def WaitSweep(self, timeout = 10, poll_min = 0.005, poll_max = 0.1):
+        """Waits for the end of the current sweep and returns as soon as it ends.
+
+        On GPIB/USB the OSA raises a service request when *OPC completes (VISA wait on event).
+        Otherwise (or if that fails) EndedSweep is polled with an increasing interval,
+        from poll_min up to poll_max.
+
+        Args:
+            timeout (float, optional): maximum waiting time [s]. Defaults to 10.
+            poll_min (float, optional): first polling interval [s]. Defaults to 0.005.
+            poll_max (float, optional): maximum polling interval [s]. Defaults to 0.1.
+
+        Returns:
+            bool: True if the sweep ended before timeout.
+        """
+        if not self.osaOK:
+            return True
+
+        ended = self.WaitSRQ(timeout)
+        if ended is not None:
+            return ended
+
+        t_end = time.time() + timeout
+        interval = poll_min
+        while not self.EndedSweep():
+            if time.time() >= t_end:
+                return False
+            time.sleep(min(interval, max(0, t_end-time.time())))
+            interval = min(2*interval, poll_max)
+        return True
+
+    def WaitSRQ(self, timeout = 10):
+        """Waits for pending operations (e.g. a sweep) to complete with *OPC and a service request.
+
+        Returns:
+            bool or None: True if completed, False on timeout, None if service requests
+                          are not available on this interface.
+        """
+        interfaces = (visa.constants.InterfaceType.gpib, visa.constants.InterfaceType.usb)
+        if not self.srq or getattr(self.osa, 'interface_type', None) not in interfaces:
+            return None
+
+        event = visa.constants.EventType.service_request
+        try:
+            self.osa.write("*CLS") #no stale event can assert the request
+            try:
+                self.osa.write("*ESE 1") #operation complete => event status bit
+                self.osa.write("*SRE 32") #event status bit => service request
+                self.osa.enable_event(event, visa.constants.EventMechanism.queue)
+                try:
+                    self.osa.write("*OPC")
+                    self.osa.wait_on_event(event, int(1000*timeout))
+                    return True
+                finally:
+                    self.osa.disable_event(event, visa.constants.EventMechanism.queue)
+                    self.osa.discard_events(event, visa.constants.EventMechanism.queue)
+            finally:
+                #later operations must not assert service requests
+                self.osa.write("*SRE 0")
+                self.osa.write("*ESE 0")
+                self.osa.write("*CLS")
+                self.osa.read_stb()
+        except visa.VisaIOError as e:
+            if e.error_code == visa.constants.StatusCode.error_timeout:
+                return False
+            print("Service requests unavailable, polling sweep status instead:", e)
+            self.srq = False
+            return None
+
+    def WaitOPC(self, timeout = 10):
+        """Blocks until pending operations (e.g. zero calibration) are complete (*OPC?).
+
+        Returns:
+            bool: False on timeout.
+        """
+        timeout_0 = self.osa.timeout
+        self.osa.timeout = 1000*timeout
+        try:
+            self.osa.query("*OPC?")
+            return True
+        except visa.VisaIOError:
+            return False
+        finally:
+            self.osa.timeout = timeout_0
             
     def SweepRange(self, lbd_ini, lbd_end, #resolution, resolution_unit = 'PM',
                     lbd_unit = 'NM'):
-        if lbd_unit == 'NM':
-            if self.print_bool: print('X-axis set as Wavelength')
-            self.HorizonScale(True) 
-        elif lbd_unit == 'THZ':
-            if self.print_bool: print('X-axis set as Frequency')
-            self.HorizonScale(False)
-        else:
-            print("Invalid unit. Possibilities: 'NM' or 'THz'")
+        with self.batch():
+            if lbd_unit == 'NM':
+                if self.print_bool: print('X-axis set as Wavelength')
+                self.HorizonScale(True) 
+            elif lbd_unit == 'THZ':
+                if self.print_bool: print('X-axis set as Frequency')
+                self.HorizonScale(False)
+            else:
+                print("Invalid unit. Possibilities: 'NM' or 'THz'")
 
-        self.osa.write(':SENSe:WAVelength:STARt {:.3f}'.format(lbd_ini)+lbd_unit)
-        self.osa.write(':SENSe:WAVelength:STOP {:.3f}'.format(lbd_end)+lbd_unit)
-        #self.osa.write(':SENSe:BANDwidth:RESolution {:.3f}'.format(resolution)+resolution_unit)
-        self.osa.write(':TRACe:ACTive TRA')
+            self.write(':SENSe:WAVelength:STARt {:.3f}'.format(lbd_ini)+lbd_unit)
+            self.write(':SENSe:WAVelength:STOP {:.3f}'.format(lbd_end)+lbd_unit)
+            #self.write(':SENSe:BANDwidth:RESolution {:.3f}'.format(resolution)+resolution_unit)
+            self.write(':TRACe:ACTive TRA')
 
 
 
@@ -434,46 +548,72 @@ class AQ63XX:
         '''
         This function interprets bytes as packed by binary data.
         It is supposed to get the output of the Yokogawa AQ6370C Optical Spectrum Analyser and convert to floats (regard-less of the span).
+        The returned float32 array is a read-only view over data_in (no copy).
         '''
-        
-        #Grab the beginning section of the image file, which will contain the header.
-        Header = str(data_in[0:12])
-        #print("Header is " + str(Header))
-        
-        #Find the start position of the IEEE header, which starts with a '#'.
-        startpos = Header.find("#")
-        #print("Start Position reported as " + str(startpos))
+        data_in = memoryview(data_in).cast('B')
+
+        #Find the start position of the IEEE header (#<number of digits><number of bytes>) in its first 12 bytes.
+        startpos = bytes(data_in[0:12]).find(b"#")
         
         #Check for problem with start position.
         if startpos < 0:
             raise IOError("No start of block found")
-            
+
+        return self.binblock_at(data_in, startpos)[0]
+
+    def binblock_at(self, data_in, startpos):
+        '''
+        Decodes the IEEE block starting (with '#') at startpos of the memoryview data_in.
+        Returns the float32 view and the position right after the block.
+        Raises IOError if data_in ends before the size declared in the header.
+        '''
         #Find the number that follows '#' symbol.  This is the number of digits in the block length.
-        Size_of_Length = int(Header[startpos+1])
-        #print("Size of Length reported as " + str(Size_of_Length))
-        
-        ##Now that we know how many digits are in the size value, get the size of the image file.
-        Image_Size = int(Header[startpos+2:startpos+2+Size_of_Length])
-        #print("Number of bytes in image file are: " + str(Image_Size))
+        Size_of_Length = int(chr(data_in[startpos+1]))
         
-        # Get the length from the header
-        offset = startpos+Size_of_Length
+        ##Now that we know how many digits are in the size value, get the size of the block.
+        Image_Size = int(bytes(data_in[startpos+2:startpos+2+Size_of_Length]))
         
-        # Extract the data out into a list.
-        data_raw = data_in[offset:offset+Image_Size]
+        # Data starts right after the header
+        offset = startpos+2+Size_of_Length
         float_len=4 #A Float takes 4 chars en this packed data
-        data_len=int( len(data_raw)/float_len )
-        #print('Number of points in data ', data_len)
-        
-        output_vec=np.zeros(data_len)
-        for i in range(data_len):
-            output_vec[i]=struct.unpack('<f', data_raw[float_len*i:float_len*(i+1)])[0]
-        
-        
-        return(output_vec)
+        if len(data_in)-offset < Image_Size:
+            raise IOError("Binary block from OSA AQ63XX is shorter than its header: {:d} of {:d} bytes".format(
+                max(0, len(data_in)-offset), Image_Size))
+        data_len = Image_Size//float_len
+
+        return np.frombuffer(data_in, dtype='<f4', count=data_len, offset=offset), offset+Image_Size
+
+    def binblock_split(self, data_in):
+        '''
+        Decodes the response to several binary queries (IEEE blocks separated by ';') into a list of float32 views.
+        '''
+        data_in = memoryview(data_in).cast('B')
+        blocks = []
+        pos = 0
+        while pos < len(data_in) and data_in[pos] == ord("#"):
+            block, pos = self.binblock_at(data_in, pos)
+            blocks.append(block)
+            if pos < len(data_in) and data_in[pos] == ord(";"):
+                pos = pos+1
+        return blocks
+
+    def ascii_block(self, data_in):
+        '''
+        Converts a comma separated ASCII response (format:data ascii) to a float64 array in one call.
+        '''
+        try:
+            output_vec = np.fromstring(data_in, dtype=np.float64, sep=',')
+        except ValueError:
+            output_vec = None
+        #older numpy versions stop at the first invalid entry instead of raising
+        if output_vec is None or len(output_vec) != data_in.count(',')+1:
+            raise IOError("Invalid ASCII trace from OSA AQ63XX")
+        return output_vec
 
     def trace_data(self, axis = "Y"):
         """
+        Returns the float32 trace (read-only view over the binary block, see binblock_raw).
+
         TODO: figure out why OSA starts zeroing in the middle of scan and how to prevent this
                 => possibility: insert try/except
         """
@@ -2,7 +2,7 @@ import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import pyLPD.MLtools as mlt
+from numeric_lib import peakdet
 
 def cband_scan(sigen, tunics, scope, config = True,
     lbd_ini = 1529, lbd_end = 1565, lbd_speed = 5,
@@ -80,7 +80,7 @@ def cband_scan(sigen, tunics, scope, config = True,
     return df
 
 def plot_diff_freq(data, fname, pkdet_delta=0.25, savefig = True):
-    ind_max, maxtab, ind_min, mintab = mlt.peakdet(data.cav.values, delta=pkdet_delta)
+    ind_max, maxtab, ind_min, mintab = peakdet(data.cav.values, delta=pkdet_delta)
     fΩ = data.freq.values[ind_min][:-1]
     Ω =  np.diff(data.freq.values[ind_min])*1e3
     mask = Ω<15
@@ -2,6 +2,9 @@
 import ivi
 import os
 import sys
+import time
+import threading
+import concurrent.futures
 equip_control_path = 'C:/Users/lpd/Documents/Leticia/DFS/EquipmentControl'
 sys.path.insert(1, equip_control_path)
 
@@ -37,78 +40,192 @@ ch_hcn=3
 #other details
 pm_delta_dB = 18.33
 
-def init_equip(**kwargs):#pxa_bool = True, tunics_bool = True, scope_bool = True, sigen_bool = True,
-               # osa1_bool = True, osa2_bool = True, pm_bool = True, edfa_bool = True,
-               # att_out_bool = True, att_in_bool = True, att_r_bool = True):
-
-    equip = {
+#instruments opened by init_equip: name => function opening it
+def _open_att_out():
+    #return VOA_lib.VOA(daq_port_t, os.path.join(equip_control_path, VOA_calib_path_t))
+    return atts.MN9625A(gpib = att_out_id)
+
+def _open_att_in():
+    return atts.DA100(resource_str = att_in_id)
+
+def _open_att_r():
+    #return att_lib.Att(resource_str = att_r_id)
+    return atts.VOA(daq_port_r, VOA_sn_r)
+
+def _open_pxa():
+    return PXA_lib.N9030A()
+
+def _open_tunics():
+    tunics = tunics_lib.T100R(ip=tunics_ip)
+    tunics.connect()
+    return tunics
+
+def _open_scope():
+    return ivi.agilent.agilentDSOX92504A(scope_id, prefer_pyvisa = True)
+
+def _open_sigen():
+    return sigen_lib.Sigen(sigen_id = sigen_id)
+
+def _open_osa(osa_id):
+    osa = aq63XX.AQ63XX()
+    osa.ConnectOSA(isgpib = False, iseth = True, ethip = osa_id, ipuser = 'anonymous', ippass='123456')
+    osa.osa.write('AUTO OFFSET OFF')
+    osa.InitOSA(print_bool=False)
+    return osa
+
+def _open_pm():
+    return thorlabs_pm_lib.PM200(pm_id)
+
+def _open_edfa():
+    return EDFA_lib.KeopsysEDFA(gpib_port=edfa_gpib_port)
+
+def _open_ted():
+    return ted200c.TED200C(dev_read=ted_read, dev_write=ted_write)
+
+_openers = {
+    'att_out': _open_att_out,
+    'att_in': _open_att_in,
+    'att_r': _open_att_r,
+    'pxa': _open_pxa,
+    'tunics': _open_tunics,
+    'scope': _open_scope,
+    'sigen': _open_sigen,
+    'osa1': lambda: _open_osa(osa1_id),
+    'osa2': lambda: _open_osa(osa2_id),
+    'pm': _open_pm,
+    'edfa': _open_edfa,
+    'ted': _open_ted,
+}
+
+
+class Equipment(dict):
+    """Equipment registry returned by init_equip: a dict (equip['tunics']) whose instruments
+    are also attributes (equip.tunics).
+
+    Attributes:
+        connect_time (dict): time each instrument took to connect [s].
+        pending (dict): futures of instruments still connecting. Each one is added to the registry when it
+                        connects, and accessing it before waits for it.
+        errors (dict): exceptions of instruments that failed. Accessing one raises it.
+    """
+    att_out: atts.MN9625A
+    att_in: atts.DA100
+    att_r: atts.VOA
+    pxa: PXA_lib.N9030A
+    tunics: tunics_lib.T100R
+    scope: ivi.agilent.agilentDSOX92504A
+    sigen: sigen_lib.Sigen
+    osa1: aq63XX.AQ63XX
+    osa2: aq63XX.AQ63XX
+    pm: thorlabs_pm_lib.PM200
+    edfa: EDFA_lib.KeopsysEDFA
+    ted: ted200c.TED200C
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connect_time = {}
+        self.pending = {}
+        self.errors = {}
+        self._lock = threading.Lock() #_collect runs both in done callbacks and in wait
+
+    def __missing__(self, key):
+        if key in self.pending:
+            self.wait(key)
+            return self[key]
+        if key in self.errors:
+            raise self.errors[key]
+        raise KeyError(key)
+
+    def __getattr__(self, name):
+        #private and special names (e.g. looked up by copy and pickle before __init__) are never instruments
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def _collect(self, name, future):
+        with self._lock:
+            if name not in self.pending:
+                return
+            try:
+                self[name], self.connect_time[name] = future.result()
+            except Exception as error:
+                self.errors[name] = error
+                print("{} failed: {!r}".format(name, error))
+            del self.pending[name]
+
+    def wait(self, name = None, timeout = None):
+        """Waits for one (or all) pending instruments.
+
+        Args:
+            name (str, optional): Defaults to None (all).
+            timeout (float, optional): [s]. Defaults to None (no limit).
+        """
+        with self._lock:
+            names = list(self.pending) if name is None else [name]
+            futures = {self.pending[name]: name for name in names if name in self.pending}
+        done, _ = concurrent.futures.wait(futures, timeout = timeout)
+        for future in done:
+            self._collect(futures[future], future)
+
+
+def _timed(name, opener):
+    time0 = time.time()
+    instr = opener()
+    connect_time = time.time() - time0
+    print("{} connected in {:.2f} s".format(name, connect_time))
+    return instr, connect_time
+
+
+def init_equip(timeout = None, max_workers = 8, **kwargs):#pxa = True, tunics = True, scope = True, sigen = True,
+               # osa1 = True, osa2 = True, pm = True, edfa = True,
+               # att_out = True, att_in = True, att_r = True, ted = True):
+    """Connects the selected instruments concurrently (e.g. init_equip(tunics = True, osa1 = True)).
+
+    Args:
+        timeout (float, optional): maximum time to wait [s]. Instruments still connecting afterwards are
+                                   left in equip.pending, and failures in equip.errors (see Equipment).
+                                   Defaults to None (waits for all).
+        max_workers (int, optional): number of instruments opened at the same time. 1 opens them one
+                                     after another. Defaults to 8.
+
+    Raises:
+        Exception: if timeout is None and any instrument failed (the others are still connected).
+
+    Returns:
+        Equipment: initialized equipment, plus the scope channels.
+    """
+    equip = Equipment({
         'scope_ch_r' : ch_reflection,
         'scope_ch_t' : ch_transmission,
         'scope_ch_mzi' : ch_mzi,
         "scope_ch_hcn" : ch_hcn,
-    }
-    #attenuators
-    if kwargs.get('att_out') is True: 
-        #att_out = VOA_lib.VOA(daq_port_t, os.path.join(equip_control_path, VOA_calib_path_t))
-        att_out = atts.MN9625A(gpib = att_out_id)
-        equip['att_out'] = att_out
-
-    if kwargs.get('att_in') is True:
-        att_in = atts.DA100(resource_str = att_in_id)
-        equip['att_in'] = att_in
-
-    if kwargs.get('att_r') is True:
-        #att_r = att_lib.Att(resource_str = att_r_id)
-        att_r = atts.VOA(daq_port_r, VOA_sn_r)
-        equip['att_r'] = att_r
-
-    #other equipment
-    if kwargs.get('pxa') is True:
-        pxa = PXA_lib.N9030A()
-        equip['pxa'] = pxa
-
-    if kwargs.get('tunics') is True:
-        tunics = tunics_lib.T100R(ip=tunics_ip)
-        tunics.connect()
-        equip['tunics'] = tunics
-
-    if kwargs.get('scope') is True:
-        scope = ivi.agilent.agilentDSOX92504A(scope_id, prefer_pyvisa = True)
-        equip['scope'] = scope
-    
-    if kwargs.get('sigen') is True:
-        sigen = sigen_lib.Sigen(sigen_id = sigen_id)
-        equip['sigen'] = sigen
-
-    if kwargs.get('osa1') is True:
-        osa1 = aq63XX.AQ63XX()
-        osa1.ConnectOSA(isgpib = False, iseth = True, ethip = osa1_id, ipuser = 'anonymous', ippass='123456')
-        osa1.osa.write('AUTO OFFSET OFF')
-        osa1.InitOSA(print_bool=False)
-        equip['osa1'] = osa1
-
-
-    if kwargs.get('osa2') is True:
-        osa2 = aq63XX.AQ63XX()
-        osa2.ConnectOSA(isgpib = False, iseth = True, ethip = osa2_id,  ipuser = 'anonymous', ippass='123456')
-        osa2.osa.write('AUTO OFFSET OFF')
-        osa2.InitOSA(print_bool=False)
-        equip['osa2'] = osa2
-
-    if kwargs.get('pm') is True:
-        pm = thorlabs_pm_lib.PM200(pm_id)
-        equip['pm'] = pm
-
-    if kwargs.get('edfa') is True:
-        edfa = EDFA_lib.KeopsysEDFA(gpib_port=edfa_gpib_port)
-        equip['edfa'] = edfa
-
-    if kwargs.get('ted') is True:
-        ted = ted200c.TED200C(dev_read=ted_read, dev_write=ted_write)
-        equip['ted'] = ted
-
-
-    print("All Equipment Initialized Successfully")
+    })
+
+    names = [name for name in _openers if kwargs.get(name) is True]
+    if not names:
+        return equip
+
+    time0 = time.time()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = min(max_workers, len(names)))
+    for name in names:
+        equip.pending[name] = executor.submit(_timed, name, _openers[name])
+    for name, future in list(equip.pending.items()):
+        future.add_done_callback(lambda future, name = name: equip._collect(name, future))
+    executor.shutdown(wait = False)
+    equip.wait(timeout = timeout)
+
+    failed = ", ".join("{} ({!r})".format(name, error) for name, error in equip.errors.items())
+    if equip.errors and timeout is None:
+        raise Exception("Equipment initialization failed: " + failed) from next(iter(equip.errors.values()))
+    if equip.errors:
+        print("Failed: " + failed)
+    if equip.pending:
+        print("Still connecting: " + ", ".join(equip.pending))
+    elif not equip.errors:
+        print("All Equipment Initialized Successfully ({:.2f} s)".format(time.time() - time0))
 
     return equip
 
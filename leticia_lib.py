@@ -9,6 +9,7 @@ from scipy import interpolate
 from matplotlib import pyplot as plt
 from matplotlib import ticker
 import pyLPD.MLtools as mlt
+from numeric_lib import interp_monotone, peakdet
 import sys
 import json
 c = constants.c
@@ -102,7 +103,7 @@ def spectra_smooth(x, y, floor, λ_ref = None, #fig_size=(5,3),
     y[y<floor] = floor
     y_sg = mlt.savitzky_golay(y, window_size = sg_wind, order = sg_o)
 
-    ind_max, maxtab, ind_min, mintab=mlt.peakdet(y_sg, pkdet)
+    ind_max, maxtab, ind_min, mintab=peakdet(y_sg, pkdet)
 
     Ω = []
     λ_peaks=[]
@@ -177,7 +178,7 @@ def spectra_cycle(osa_cycle, lbd_cycle, δ_lst,
 
         osa_peakdet = osa_smooth[::, ii]
         osa_peakdet[osa_peakdet<peakdet_floor] = peakdet_floor
-        ind_max, maxtab, ind_min, mintab=mlt.peakdet(osa_peakdet, 3)
+        ind_max, maxtab, ind_min, mintab=peakdet(osa_peakdet, 3)
         lbd_lst[ii]=lbd_cycle[ind_max[0], ii]
 
 
@@ -194,8 +195,7 @@ def spectra_cycle(osa_cycle, lbd_cycle, δ_lst,
     center_lst = np.zeros((len(δ_lst), l))
     for ii in ii_lst:
         δ=fit_y[ii]
-        interp=interpolate.interp1d(lbd_cycle[:, ii]-δ, osa_smooth[:, ii])
-        center_lst[:, ii] = interp(δ_lst)
+        interp_monotone(δ_lst, lbd_cycle[:, ii]-δ, osa_smooth[:, ii], out=center_lst[:, ii])
         
     return center_lst, fit_y
 
@@ -205,8 +205,7 @@ def spectra_shift(x, y, λ, δλ_lst, sg_w = 33,
         y[y<smooth_floor] = smooth_floor
         y = mlt.savitzky_golay(y, window_size = sg_w, order = 2)
     
-    interp=interpolate.interp1d(x-λ, y)
-    y_centered = interp(δλ_lst)
+    y_centered = interp_monotone(δλ_lst, x-λ, y)
     
     return y_centered
 
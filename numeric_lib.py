@@ -0,0 +1,240 @@
+"""Numeric helpers shared by the instrument routines and the wavelength calibration:
+hysteresis peak detection and monotone linear interpolation. Only numpy is needed,
+so instrument scripts can use them without loading the calibration pipeline.
+
+Example:
+-------
+from numeric_lib import peakdet, interp_monotone
+
+ind_max, maxtab, ind_min, mintab = peakdet(y, delta = 0.3)
+y_new = interp_monotone(x_new, x, y)
+
+python numeric_lib.py     # checks peakdet against fixed cases and peakdet_reference
+"""
+
+#%%
+import numpy as np
+
+
+def interp_monotone(x, xp, fp, out = None, bounds_error = True, block_size = 2**20):
+    """Linear interpolation of (xp, fp) at x, for a monotone (ascending or descending) xp.
+
+    Replaces interpolate.interp1d(xp, fp)(x) without building the interpolator object.
+    The result may be written in place into a preallocated buffer, block by block,
+    so no temporary array of the size of x is created.
+
+    Args:
+        x (array): points where to interpolate.
+        xp (array): monotone sample points (e.g. times of mzi peaks).
+        fp (array): values at xp.
+        out (float64 array, optional): buffer with the shape of x. Defaults to a new array.
+        bounds_error (bool, optional): If true raises ValueError for x outside xp (as interp1d).
+                                        Otherwise, values are clamped. Defaults to True.
+        block_size (int, optional): points interpolated at a time when writing into out.
+
+    Returns:
+        float64 array: interpolated values (out, if given).
+    """
+    x = np.asarray(x)
+    xp = np.asarray(xp)
+    fp = np.asarray(fp)
+    if len(xp) > 1 and xp[0] > xp[-1]:
+        xp, fp = xp[::-1], fp[::-1]
+
+    if bounds_error and len(x):
+        if x.min() < xp[0]:
+            raise ValueError("A value in x_new is below the interpolation range.")
+        if x.max() > xp[-1]:
+            raise ValueError("A value in x_new is above the interpolation range.")
+
+    if out is None:
+        return np.interp(x, xp, fp)
+
+    if x.ndim != 1:
+        out[...] = np.interp(x, xp, fp)
+        return out
+
+    for ii in range(0, len(x), block_size):
+        out[ii:ii+block_size] = np.interp(x[ii:ii+block_size], xp, fp)
+    return out
+
+def peakdet(v, delta, x = None, min_removed = 0.01):
+    """Detects peaks with the same delta-hysteresis as pyLPD.MLtools.peakdet (a maximum
+    is confirmed once the signal falls delta below it, a minimum once it rises delta above it),
+    without looping over every sample in python.
+
+    The signal is reduced to its turning points (plateaus keep their first index), which is
+    where peakdet can confirm a peak. Swings smaller than delta nested inside a larger swing
+    cannot change the result and are removed in vectorized rounds. The hysteresis loop then
+    only runs over the few remaining points.
+
+    Args:
+        v (array): signal.
+        delta (float): minimum swing of a peak.
+        x (array, optional): positions returned instead of the indexes. Defaults to None.
+        min_removed (float, optional): the vectorized rounds stop when they remove less than this
+                                        fraction of the remaining points. Defaults to 0.01.
+
+    Returns:
+        [array, array, array, array]: indexes of maxima, values of maxima, indexes of minima, values of minima.
+    """
+    v = np.asarray(v, dtype=float)
+    if len(v) < 2:
+        return _peakdet_output([], [], [], [], x)
+
+    #first index of each plateau, then turning points (and both ends)
+    dv = np.diff(v)
+    pos = np.arange(len(v)) if np.all(dv) else np.r_[0, np.flatnonzero(dv)+1]
+    rising = np.diff(v[pos]) > 0 if len(pos) < len(v) else dv > 0
+    del dv
+    if len(rising):
+        pos = pos[np.r_[0, np.flatnonzero(rising[1:] != rising[:-1])+1, len(pos)-1]]
+    val = v[pos]
+
+    #removing pairs (k, k+1) of neighbours closer than delta, when k-1 and k+2 are more extreme
+    parity = 0
+    idle_rounds = 0
+    while len(val) >= 4 and idle_rounds < 2:
+        m = len(val)
+        prv, this, nxt, after = (val[parity+i:m-3+i:2] for i in range(4))
+        remove = (np.abs(this - nxt) < delta) & np.where(this > nxt,
+                    (this < after) & (nxt >= prv),
+                    (this > after) & (nxt <= prv))
+        n_removed = 2*np.count_nonzero(remove)
+        if n_removed:
+            keep = np.ones(m, dtype=bool)
+            keep[1+parity:m-2:2] = ~remove
+            keep[2+parity:m-1:2] = ~remove
+            pos, val = pos[keep], val[keep]
+        idle_rounds = 0 if n_removed > min_removed*len(val) else idle_rounds+1
+        parity = 1 - parity
+
+    #pyLPD.MLtools.peakdet loop over the remaining points. After a peak is confirmed by point i,
+    #every swing larger than delta from i on confirms the next peak: such runs are taken at once
+    decisive = np.where(val[1:] < val[:-1], val[1:] < val[:-1]-delta, val[1:] > val[:-1]+delta)
+    not_decisive = np.r_[np.flatnonzero(~decisive), len(val)-1]
+    is_max, is_min = np.zeros(len(val), dtype=bool), np.zeros(len(val), dtype=bool)
+    values = val.tolist()
+
+    mn, mx = np.inf, -np.inf
+    mnk = mxk = 0
+    lookformax = True
+    i = 0
+    while i < len(values):
+        this = values[i]
+        if this > mx: mx, mxk = this, i
+        if this < mn: mn, mnk = this, i
+
+        if lookformax:
+            if not this < mx-delta:
+                i += 1
+                continue
+            is_max[mxk] = True
+            mn, mnk = this, i
+            lookformax = False
+        else:
+            if not this > mn+delta:
+                i += 1
+                continue
+            is_min[mnk] = True
+            mx, mxk = this, i
+            lookformax = True
+
+        r = not_decisive[np.searchsorted(not_decisive, i)]
+        if r > i:
+            #point i is a maximum if lookformax (peaks alternate up to r-1, r confirms r-1)
+            i_max, i_min = (i, i+1) if lookformax else (i+1, i)
+            is_max[i_max:r:2] = True
+            is_min[i_min:r:2] = True
+            lookformax = lookformax == ((r-i)%2 == 0)
+            mx, mxk = (values[r], r) if lookformax else (values[r-1], r-1)
+            mn, mnk = (values[r-1], r-1) if lookformax else (values[r], r)
+            i = r
+        i += 1
+
+    return _peakdet_output(pos[is_max], val[is_max], pos[is_min], val[is_min], x)
+
+def _peakdet_output(ind_max, maxtab, ind_min, mintab, x):
+    ind_max, ind_min = np.array(ind_max, dtype=int), np.array(ind_min, dtype=int)
+    if x is not None:
+        x = np.asarray(x)
+        ind_max, ind_min = x[ind_max], x[ind_min]
+    return ind_max, np.array(maxtab, dtype=float), ind_min, np.array(mintab, dtype=float)
+
+def peakdet_reference(v, delta):
+    """Sample by sample delta-hysteresis peak detection, the algorithm of pyLPD.MLtools.peakdet,
+    except that it returns empty tables where pyLPD fails (no maximum or no minimum). Slow: peakdet
+    must return exactly the same.
+
+    Returns:
+        [array, array, array, array]: indexes of maxima, values of maxima, indexes of minima, values of minima.
+    """
+    maxtab, mintab = [], []
+    mn, mx = np.inf, -np.inf
+    mnpos = mxpos = 0
+    lookformax = True
+    for i, this in enumerate(np.asarray(v, dtype=float)):
+        if this > mx: mx, mxpos = this, i
+        if this < mn: mn, mnpos = this, i
+        if lookformax:
+            if this < mx-delta:
+                maxtab.append((mxpos, mx))
+                mn, mnpos = this, i
+                lookformax = False
+        elif this > mn+delta:
+            mintab.append((mnpos, mn))
+            mx, mxpos = this, i
+            lookformax = True
+    maxtab, mintab = np.array(maxtab).reshape(-1, 2), np.array(mintab).reshape(-1, 2)
+    return maxtab[:, 0].astype(int), maxtab[:, 1], mintab[:, 0].astype(int), mintab[:, 1]
+
+#(signal, delta) => (indexes of maxima, indexes of minima)
+peakdet_cases = [
+    ([], 1, ([], [])),
+    ([1.], 1, ([], [])),
+    ([0., 1, 2, 3, 4], 1, ([], [])),                #monotone: no peak confirmed
+    ([0., 3, 3, 3, 0], 1, ([1], [])),               #plateau: first index, no minimum
+    ([3., 0, 0, 3], 1, ([0], [1])),
+    ([0., 2, 1.5, 2.5, 0, 1], 1, ([3], [])),        #swing smaller than delta is skipped
+    ([0., 2, 0, 2, 0, 2], 1, ([1, 3], [2, 4])),
+    ([0., 2, 0, 2, 0, 2], 2, ([], [])),             #swings equal to delta do not count
+]
+
+def compare_peakdet(v, delta, label = 'signal'):
+    """Asserts that peakdet(v, delta) equals peakdet_reference(v, delta)."""
+    for a, b in zip(peakdet(v, delta), peakdet_reference(v, delta)):
+        assert np.array_equal(a, b), 'peakdet differs from peakdet_reference on '+label
+
+def check_peakdet(n_random = 1000, seed = 0, callback = None):
+    """Checks peakdet on peakdet_cases and, against peakdet_reference, on short random signals
+    (noise, random walks and quantized signals with plateaus), including empty signals and signals
+    without maxima or minima.
+
+    Args:
+        n_random (int, optional): number of random signals. Defaults to 1000.
+        seed (int, optional): random seed. Defaults to 0.
+        callback (callable, optional): also called as callback(v, delta, label) for each random signal.
+
+    Raises:
+        AssertionError: if an output differs.
+    """
+    for v, delta, (ind_max, ind_min) in peakdet_cases:
+        output = peakdet(v, delta)
+        assert np.array_equal(output[0], ind_max) and np.array_equal(output[2], ind_min), \
+            'peakdet({}, {}) returned maxima {} and minima {}'.format(v, delta, output[0], output[2])
+        assert np.array_equal(output[1], np.take(v, ind_max)) and np.array_equal(output[3], np.take(v, ind_min))
+
+    rng = np.random.default_rng(seed)
+    for ii in range(n_random):
+        n = rng.integers(0, 300)
+        v = [rng.standard_normal(n), np.cumsum(rng.standard_normal(n)),
+             rng.integers(0, 5, n).astype(float)][ii % 3]
+        delta = rng.uniform(0.05, 3)
+        compare_peakdet(v, delta, 'random signal {:d}'.format(ii))
+        if callback is not None:
+            callback(v, delta, 'random signal {:d}'.format(ii))
+
+#%%
+if __name__=='__main__':
+    check_peakdet()
+    print('peakdet: {:d} fixed cases and 1000 random signals OK'.format(len(peakdet_cases)))
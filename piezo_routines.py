@@ -10,6 +10,7 @@ import sys
 equip_control_path = 'C:/Users/lpd/Documents/Leticia/DFS/EquipmentControl'
 sys.path.insert(1, equip_control_path)
 import leticia_lib as llb
+import scpi_lib
 
 
 
@@ -86,12 +87,13 @@ def start_scan( sigen, tunics, scope,
     #tunics.power.on()
     sigen.output.on()
 
-    #oscilloscope trigger on aux port
-    scope._write(":ACQuire:POINts 1000000")
-    scope._write(":RUN")
-    scope._write(':TRIGger:EDGE:SOURce AUX')
-    scope._write(":TRIGger:LEVel AUX, 1")
-    scope._write(":TIMebase:ROLL:ENABLE OFF")
+    #oscilloscope trigger on aux port (one message)
+    with scpi_lib.Batch(scope._write, scope._ask) as scope_batch:
+        scope_batch.write(":ACQuire:POINts 1000000")
+        scope_batch.write(":RUN")
+        scope_batch.write(':TRIGger:EDGE:SOURce AUX')
+        scope_batch.write(":TRIGger:LEVel AUX, 1")
+        scope_batch.write(":TIMebase:ROLL:ENABLE OFF")
     scope.acquisition.time_per_record =2.5/sigen.frequency
 
 def end_scan(sigen, tunics, scope,
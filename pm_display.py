@@ -13,9 +13,10 @@ from equipment_init import init_equip
 import leticia_lib as llb
 import piezo_routines as piezo
 import cband_sweep as cbs
-import WavelengthCalibration.wavelength_calibration as wc
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'WavelengthCalibration'))
+import wavelength_calibration as wc
 import pyLPD.MLtools as mlt
-import WavelengthCalibration.piezo_fsc as pz
+import piezo_fsc as pz
 
 
 class MainWindow(QMainWindow):
@@ -0,0 +1,153 @@
+# %%
+"""
+Coalescing of SCPI commands: the commands written inside a batch are sent as
+a single semicolon-joined message (one round trip instead of one per command),
+and the instrument error queue is checked once at the end. The message starts
+with clear_command ('*CLS') so that only errors caused by the batch are reported.
+
+Example:
+-------
+with osa.batch():
+    osa.write(':SENSe:WAVelength:STARt 1550.000NM')
+    osa.write(':SENSe:WAVelength:STOP 1560.000NM')
+
+with scpi_lib.Batch(scope._write, scope._ask) as scope_batch:   #any write/query pair
+    scope_batch.write(':RUN')
+    scope_batch.write(':TIMebase:ROLL:ENABLE OFF')
+"""
+
+class SCPIError(Exception):
+    """Exception raised when the instrument reports errors after a batch.
+
+    Attributes:
+        errors (list): entries read from the error queue.
+    """
+    def __init__(self, errors, message = "Instrument reported SCPI errors"):
+        self.errors = errors
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message + ": " + "; ".join(self.errors)
+
+
+class Batch:
+    """Buffers SCPI commands and sends them as one semicolon-joined message when the with block exits.
+    If the block raises, the buffered commands are discarded.
+
+    Args:
+        write (callable): sends one message to the instrument.
+        query (callable, optional): queries the instrument, used to read the error queue. Defaults to None (no check).
+        check_errors (bool, optional): If true reads the error queue after sending. Defaults to True.
+        error_query (str, optional): Defaults to ':SYSTem:ERRor?'.
+        max_errors (int, optional): maximum number of error queue entries read. Defaults to 20.
+        clear_command (str, optional): sent first to empty the error queue when errors are checked. Defaults to '*CLS'.
+    """
+    def __init__(self, write, query = None, check_errors = True, error_query = ':SYSTem:ERRor?', max_errors = 20,
+                 clear_command = '*CLS'):
+        self._write = write
+        self._query = query
+        self.check_errors_bool = check_errors
+        self.error_query = error_query
+        self.max_errors = max_errors
+        self.clear_command = clear_command
+        self.commands = []
+
+    def write(self, msg):
+        self.commands.append(msg.strip())
+
+    def message(self):
+        """Buffered commands joined by ';'. Each command starts with ':' so that it is parsed from the SCPI root."""
+        return ";".join(":" + cmd.lstrip(":") if cmd[0] != "*" else cmd for cmd in self.commands if cmd)
+
+    def flush(self):
+        """Sends the buffered commands (if any) as one message."""
+        msg = self.message()
+        self.commands = []
+        if msg:
+            return self._write(msg)
+
+    def check_errors(self):
+        """Reads the error queue until it is empty.
+
+        Raises:
+            SCPIError: if any error was reported.
+        """
+        errors = []
+        for ii in range(self.max_errors):
+            resp = self._query(self.error_query).strip()
+            try:
+                code = int(resp.split(",")[0])
+            except ValueError:
+                code = -1
+            if code == 0:
+                break
+            errors.append(resp)
+
+        if errors:
+            raise SCPIError(errors)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.commands = []
+            return False
+
+        check = any(self.commands) and self.check_errors_bool and self._query is not None
+        if check and self.clear_command:
+            self.commands.insert(0, self.clear_command)
+        self.flush()
+        if check:
+            self.check_errors()
+        return False
+
+
+class Batching:
+    """Mixin for instrument classes with write(msg) and query(msg) methods.
+
+    write should start with `if self._batched(msg): return`, so that inside
+    `with instr.batch():` commands are buffered instead of sent. Queries are
+    always sent immediately.
+    """
+    _batch = None
+
+    def batch(self, check_errors = True):
+        """Context manager coalescing the writes of its block into one message.
+        Nested batches join the outermost one."""
+        if self._batch is not None:
+            return _NestedBatch(self._batch)
+        return _InstrumentBatch(self, check_errors)
+
+    def _batched(self, msg):
+        """Buffers msg if inside batch(). Returns True if it was buffered."""
+        if self._batch is None:
+            return False
+        self._batch.write(msg)
+        return True
+
+
+class _InstrumentBatch(Batch):
+    def __init__(self, instr, check_errors):
+        super().__init__(instr.write, instr.query, check_errors = check_errors)
+        self.instr = instr
+
+    def __enter__(self):
+        self.instr._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instr._batch = None
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class _NestedBatch:
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __enter__(self):
+        return self.batch
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
@@ -11,12 +11,20 @@
 
 #%%
 import visa
+import scpi_lib
 _sigen_id = 'USB0::0x0957::0x2B07::MY52701124::INSTR'
+_state_slots = () #instrument state memories that waveform presets may overwrite (*SAV/*RCL). None by default
 
 
-class Sigen:
+class Sigen(scpi_lib.Batching):
     def __init__(self, sigen_id = _sigen_id, 
-                high_impedance = True, v_limits = True):
+                high_impedance = True, v_limits = True, state_slots = _state_slots):
+        """
+        Args:
+            state_slots (tuple, optional): state memories (1 to 4) that waveforms.define may overwrite with *SAV.
+                                           Defaults to _state_slots (none: presets are not uploaded).
+        """
+        self.state_slots = tuple(state_slots)
         self.rm = visa.ResourceManager()
         try:
             self.sigen = self.rm.open_resource(_sigen_id, read_termination="\n")
@@ -45,6 +53,7 @@ class Sigen:
         return self.sigen.query('*OPC?')
 
     def write(self, msg):
+        if self._batched(msg): return
         self.sigen.write(msg)
 
     def query(self, msg):
@@ -82,6 +91,7 @@ class Sigen:
     class Waveforms:
         def __init__(self, outer):
             self.outer = outer
+            self.presets = {}
 
         def _write(self, msg):
             self.outer.write(msg)
@@ -101,24 +111,26 @@ class Sigen:
             Returns:
                 str: expected output is "1\n" of "*OPC?" command
             """
-            self._write('FUNCtion RAMP')
-            self.outer.function = 'ramp'
+            if symmetry is not None and not (symmetry>=0 and symmetry<= 100):
+                raise Exception("Symmetry value is out of bounds. It should be in the interval [0,100].")
+
+            with self.outer.batch():
+                self._write('FUNCtion RAMP')
 
-            if symmetry is not None:
-                if symmetry>=0 and symmetry<= 100:
+                if symmetry is not None:
                     self._write('FUNCtion:RAMP:SYMMetry {:.3f}'.format(symmetry))
-                else:
-                    raise Exception("Symmetry value is out of bounds. It should be in the interval [0,100].")
 
-            if frequency is not None: 
-                self._write('FREQ {:.3f}'.format(frequency))
-                self.outer.frequency = frequency
+                if frequency is not None: 
+                    self._write('FREQ {:.3f}'.format(frequency))
+
+                if amplitude is not None: 
+                    self._write('VOLTage {:.3f}'.format(amplitude))
 
-            if amplitude is not None: 
-                self._write('VOLTage {:.3f}'.format(amplitude))
+                if offset is not None: 
+                    self._write('VOLTage:OFFSet {:.3f}'.format(offset))
 
-            if offset is not None: 
-                self._write('VOLTage:OFFSet {:.3f}'.format(offset))
+            self.outer.function = 'ramp'
+            if frequency is not None: self.outer.frequency = frequency
 
             return self._opc()
 
@@ -134,24 +146,89 @@ class Sigen:
                 str: expected output is "1" of "*OPC?" command
             """
 
-            self._write("FUNCtion SIN")
-            self.outer.function = 'sin'
+            with self.outer.batch():
+                self._write("FUNCtion SIN")
 
-            if frequency is not None:
-                self._write('FREQ {:.3f}'.format(frequency))
-                self.outer.frequency = frequency
+                if frequency is not None:
+                    self._write('FREQ {:.3f}'.format(frequency))
 
-            if volt_high is not None:  
-                self._write("VOLTage:HIGH {:.3f}".format(volt_high))
+                if volt_high is not None:  
+                    self._write("VOLTage:HIGH {:.3f}".format(volt_high))
 
-            if volt_low is not None:  
-                self._write("VOLTage:LOW {:.3f}".format(volt_low))
+                if volt_low is not None:  
+                    self._write("VOLTage:LOW {:.3f}".format(volt_low))
 
-            if phase is not None:  
-                self._write("PHASe {:.3f}".format(phase))
+                if phase is not None:  
+                    self._write("PHASe {:.3f}".format(phase))
+
+            self.outer.function = 'sin'
+            if frequency is not None: self.outer.frequency = frequency
 
             return self._opc()
 
+        def define(self, name, function = 'ramp', upload = None, **params):
+            """Defines a named waveform preset and applies it, e.g.
+            define('polarization', 'ramp', symmetry=90, frequency=5, amplitude=5, offset=0).
+            With upload the whole instrument state is saved in a free memory of outer.state_slots (*SAV),
+            overwriting what was stored there, so that select(name) recalls it with a single command.
+            Without upload select sends all the settings in one message.
+            Preset names are only known in this session.
+
+            Args:
+                name (str): preset name. Defining an existing name replaces it (and reuses its memory).
+                function (str, optional): 'ramp' or 'sine'. Defaults to 'ramp'.
+                upload (bool, optional): If true saves the state in the instrument. Defaults to None
+                                         (true if outer.state_slots is not empty).
+                **params: arguments of ramp or sine.
+
+            Raises:
+                Exception: if upload is requested and no memory of outer.state_slots is free.
+
+            Returns:
+                int: state memory of the preset (None if not uploaded)
+            """
+            if function not in ('ramp', 'sine'):
+                raise Exception("Waveform preset function should be 'ramp' or 'sine'.")
+            if upload is None: upload = bool(self.outer.state_slots)
+
+            slot = None
+            if upload:
+                old_slot = self.presets[name]['slot'] if name in self.presets else None
+                used = [preset['slot'] for preset in self.presets.values()]
+                free = [ii for ii in self.outer.state_slots if ii not in used]
+                slot = old_slot if old_slot is not None else (free[0] if free else None)
+                if slot is None:
+                    raise Exception("Sigen: no free state memory for preset '"+name+"' (state_slots = "
+                                    +str(self.outer.state_slots)+"). Use upload=False.")
+
+            getattr(self, function)(**params)
+            if slot is not None:
+                self._write('*SAV {:d}'.format(slot))
+                self._opc()
+
+            self.presets[name] = {'function': function, 'params': params, 'slot': slot,
+                                  'function_name': self.outer.function, 'frequency': self.outer.frequency}
+            return slot
+
+        def select(self, name):
+            """Switches to a preset defined with define(name, ...). Uploaded presets are recalled
+            with a single '*RCL n;*OPC?' query (all settings are restored as they were saved).
+
+            Returns:
+                str: expected output is "1" of "*OPC?" command
+            """
+            if name not in self.presets:
+                raise Exception("Unknown waveform preset: "+name)
+            preset = self.presets[name]
+
+            if preset['slot'] is None:
+                return getattr(self, preset['function'])(**preset['params'])
+
+            output = self.outer.query('*RCL {:d};*OPC?'.format(preset['slot']))
+            self.outer.function = preset['function_name']
+            self.outer.frequency = preset['frequency']
+            return output
+
 
 
         
@@ -159,10 +236,15 @@ class Sigen:
 if __name__=='__main__':
     import time
 
-    sigen = Sigen(_sigen_id)
-    sigen.waveforms.ramp(symmetry=75, frequency=3.5, amplitude=2, offset=0)
+    sigen = Sigen(_sigen_id, state_slots = (1, 2))
+    sigen.waveforms.define('slow', 'ramp', symmetry=75, frequency=3.5, amplitude=2, offset=0)
+    sigen.waveforms.define('fast', 'ramp', symmetry=90, frequency=5, amplitude=5, offset=0)
+
+    sigen.waveforms.select('slow')
     sigen.output.on()
+    time.sleep(5)
 
+    sigen.waveforms.select('fast')
     time.sleep(5)
     sigen.output.off()
 
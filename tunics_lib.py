@@ -5,8 +5,14 @@ Date: Sep 2021
 Email: leticiamagalhaes5@gmail.com
 """
 
+import os
+import json
 import socket
 import time
+import asyncio
+import datetime
+import numpy as np
+import scpi_lib
 
 #definitions
 ip = 'yetula.ifi.unicamp.br'
@@ -14,21 +20,240 @@ wavelength_mode = 'BASIC' #Options: 'HWA' (High Wavelength Accuracy mode), 'MHF'
 sweep_mode = 'CONTinuous' #Options: STEPped (step-by-step scanning of the wavelength range), 'CONTinuous' (continuous scanning of the wavelength range)
 sweep_repeat_mode = 'ONEWay' #Options: 'ONEWay' (One Way repeat mode), 'TWOWay' (Two Way repeat mode)
 sweep_max_cycles = 5 #Maximum number of cycles for wavelength sweep
+poll_interval = 0.05 #[s] interval between sweep state queries when waiting for a sweep
+trigger_output = 'STFinished' #Trigger output in stepped sweeps. Options: 'DISabled', 'STFinished' (step finished), 'SWStarted' (sweep started), 'SWFinished' (sweep finished)
 
-wavelength_correction = {
+#framing of the TCP connection, shared by T100R, AsyncT100R and tunics_sim: each message ends with
+#write_termination and the laser answers each message with one reply ending with read_termination
+write_termination = '\n'
+read_termination = '\n'
+
+calib_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tunics_calibration.json') #history of wavelength calibrations
+
+wavelength_correction = { #used when calib_filename is not found
     'slope' : 0.0005118863696938188,
     'intercept' : -0.7326774176629481,
     'calib_date': 'november 13, 2021',
     'unit': 'NM'
 }
 
-class T100R:
+def _split_reply(buffer):
+    """ Splits the first complete reply off the received bytes.
+    Returns:
+        (str or None, bytes): reply without terminator and whitespace (None if incomplete), remaining bytes.
+    """
+    reply, sep, rest = buffer.partition(read_termination.encode('ascii'))
+    if not sep:
+        return None, buffer
+    return reply.decode('ascii').strip(), rest
+
+def _to_date(date):
+    """ Converts 'YYYY-MM-DD' or 'november 13, 2021' strings (and datetimes) to datetime.date. """
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    if isinstance(date, datetime.date):
+        return date
+    try:
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    except ValueError:
+        return datetime.datetime.strptime(date, '%B %d, %Y').date()
+
+class WavelengthCorrection:
+    """ Correction of the laser wavelength: lbd_real = lbd_nominal + offset(lbd_nominal).
+    The offset is a polynomial (np.polyval coefficients, highest power first) or a piecewise linear
+    function (offsets at breakpoints, constant outside them). All methods take scalars or arrays.
+
+    Example:
+    -------
+    correction = load_wavelength_correction('2022-03-01')     #calibration in use at that date
+    data['lbd'] = correction.lbd_real(data['lbd'].values)
+
+    correction = WavelengthCorrection.fit(lbd_set, lbd_measured, kind = 'piecewise', breakpoints = np.arange(1500, 1631, 10))
+    save_wavelength_correction(correction)
+    """
+
+    def __init__(self, kind = 'polynomial', coefficients = None, breakpoints = None, offsets = None,
+                 calib_date = None, version = None, unit = 'NM', note = ''):
+        if kind == 'polynomial':
+            if coefficients is None:
+                raise ValueError('WavelengthCorrection: polynomial correction needs coefficients.')
+            self.coefficients = np.asarray(coefficients, dtype = float)
+        elif kind == 'piecewise':
+            if breakpoints is None or offsets is None or len(breakpoints) != len(offsets):
+                raise ValueError('WavelengthCorrection: piecewise correction needs breakpoints and offsets of the same length.')
+            order = np.argsort(breakpoints)
+            self.breakpoints = np.asarray(breakpoints, dtype = float)[order]
+            self.offsets = np.asarray(offsets, dtype = float)[order]
+        else:
+            raise ValueError("WavelengthCorrection: kind must be 'polynomial' or 'piecewise', not "+repr(kind))
+
+        self.kind = kind
+        self.calib_date = None if calib_date is None else _to_date(calib_date)
+        self.version = version
+        self.unit = unit
+        self.note = note
+
+    def __repr__(self):
+        return 'WavelengthCorrection(kind={!r}, version={!r}, calib_date={!r})'.format(
+            self.kind, self.version, None if self.calib_date is None else self.calib_date.isoformat())
+
+    def offset(self, lbd_nom):
+        """ lbd_real - lbd_nominal, at the nominal wavelengths lbd_nom. """
+        if self.kind == 'polynomial':
+            return np.polyval(self.coefficients, lbd_nom)
+        return np.interp(lbd_nom, self.breakpoints, self.offsets)
+
+    def lbd_real(self, lbd_nom):
+        """ Real wavelengths of the nominal (laser) wavelengths lbd_nom. """
+        return lbd_nom + self.offset(lbd_nom)
+
+    def lbd_nominal(self, lbd, tol = 1e-9, max_iter = 50):
+        """ Nominal (laser) wavelengths giving the real wavelengths lbd, by fixed point iteration
+        lbd_nom = lbd - offset(lbd_nom). Each iteration multiplies the error by ~|d offset/d lbd|
+        (5e-4 for the 2021 calibration), so it converges in a few iterations.
+        Args:
+            tol (float, optional): stops when no wavelength changes by more than tol. Defaults to 1e-9.
+            max_iter (int, optional): Defaults to 50.
+        Raises:
+            Exception: if it does not converge (|d offset/d lbd| close to or above 1).
+        """
+        lbd_nom = lbd - self.offset(lbd)
+        for ii in range(max_iter):
+            lbd_next = lbd - self.offset(lbd_nom)
+            if np.max(np.abs(lbd_next - lbd_nom)) <= tol:
+                return lbd_next
+            lbd_nom = lbd_next
+        raise Exception('WavelengthCorrection: lbd_nominal did not converge in {} iterations.'.format(max_iter))
+
+    @classmethod
+    def fit(cls, lbd_nom, lbd_real, kind = 'polynomial', deg = 1, breakpoints = None, calib_date = None, **kwargs):
+        """ Least squares fit of the offset lbd_real - lbd_nom.
+        Args:
+            lbd_nom (array): wavelengths set on the laser.
+            lbd_real (array): measured wavelengths.
+            kind (str, optional): 'polynomial' or 'piecewise'. Defaults to 'polynomial'.
+            deg (int, optional): degree of the polynomial. Defaults to 1.
+            breakpoints (array, optional): breakpoints of the piecewise correction. Defaults to None.
+            calib_date (optional): Defaults to today.
+        """
+        lbd_nom = np.asarray(lbd_nom, dtype = float)
+        offset = np.asarray(lbd_real, dtype = float) - lbd_nom
+        if calib_date is None: calib_date = datetime.date.today()
+
+        if kind == 'polynomial':
+            return cls('polynomial', coefficients = np.polyfit(lbd_nom, offset, deg), calib_date = calib_date, **kwargs)
+        #piecewise linear: offset = sum of offsets[k]*hat_k(lbd), hat_k being 1 at breakpoints[k] and 0 at the others
+        breakpoints = np.sort(np.asarray(breakpoints, dtype = float))
+        basis = np.stack([np.interp(lbd_nom, breakpoints, hat) for hat in np.eye(len(breakpoints))], axis = 1)
+        offsets = np.linalg.lstsq(basis, offset, rcond = None)[0]
+        return cls('piecewise', breakpoints = breakpoints, offsets = offsets, calib_date = calib_date, **kwargs)
+
+    @classmethod
+    def from_dict(cls, calib):
+        """ From an entry of the calibration file, or a dict with 'slope' and 'intercept' (as wavelength_correction). """
+        calib = dict(calib)
+        if 'slope' in calib:
+            calib['coefficients'] = [calib.pop('slope'), calib.pop('intercept')]
+        return cls(**calib)
+
+    def to_dict(self):
+        calib = {'version': self.version,
+                 'calib_date': None if self.calib_date is None else self.calib_date.isoformat(),
+                 'kind': self.kind, 'unit': self.unit, 'note': self.note}
+        if self.kind == 'polynomial':
+            calib['coefficients'] = self.coefficients.tolist()
+        else:
+            calib['breakpoints'] = self.breakpoints.tolist()
+            calib['offsets'] = self.offsets.tolist()
+        return calib
+
+def load_wavelength_corrections(filename = None):
+    """ Reads the calibration history.
+    Args:
+        filename (str, optional): Defaults to calib_filename.
+    Returns:
+        list: WavelengthCorrection objects sorted by date.
+    """
+    if filename is None: filename = calib_filename
+    with open(filename, 'r') as jsonfile:
+        history = json.load(jsonfile)
+    return sorted((WavelengthCorrection.from_dict(calib) for calib in history), key = lambda corr: corr.calib_date)
+
+def load_wavelength_correction(date = None, version = None, filename = None):
+    """ Calibration in use at date: the latest one made on or before it.
+    Args:
+        date (str or datetime.date, optional): Defaults to None (latest calibration).
+        version (int, optional): If set, picks this version instead. Defaults to None.
+        filename (str, optional): Defaults to calib_filename. If the default file is not found,
+                                  wavelength_correction is used.
+    Returns:
+        WavelengthCorrection
+    """
+    try:
+        history = load_wavelength_corrections(filename)
+    except FileNotFoundError:
+        if filename is not None: raise
+        return WavelengthCorrection.from_dict(wavelength_correction)
+
+    if version is not None:
+        for corr in history:
+            if corr.version == version:
+                return corr
+        raise ValueError('Tunics T100R: no wavelength calibration with version {}.'.format(version))
+    if date is not None:
+        date = _to_date(date)
+        history = [corr for corr in history if corr.calib_date <= date]
+        if not history:
+            raise ValueError('Tunics T100R: no wavelength calibration before {}.'.format(date.isoformat()))
+    return history[-1]
+
+def save_wavelength_correction(correction, filename = None):
+    """ Appends correction to the calibration history, as a new version. Returns the version. """
+    if filename is None: filename = calib_filename
+    try:
+        with open(filename, 'r') as jsonfile:
+            history = json.load(jsonfile)
+    except FileNotFoundError:
+        history = []
+    correction.version = 1 + max((calib['version'] for calib in history), default = 0)
+    history.append(correction.to_dict())
+    with open(filename, 'w') as jsonfile:
+        jsonfile.write(json.dumps(history, indent = 4))
+    return correction.version
+
+def stepped_wavelengths(lbd_ini, lbd_end, lbd_step, decimals = 3):
+    """ Nominal wavelengths of a stepped sweep from lbd_ini towards lbd_end, as the laser steps them.
+    Args:
+        lbd_ini (float): first wavelength.
+        lbd_end (float): last wavelength (reached if the span is a multiple of lbd_step).
+        lbd_step (float): step width (positive).
+        decimals (int, optional): resolution of the values sent to the laser. Defaults to 3.
+    Returns:
+        array: wavelengths, in the unit of the arguments.
+    """
+    lbd_ini, lbd_end, lbd_step = (round(val, decimals) for val in (lbd_ini, lbd_end, abs(lbd_step)))
+    n_steps = int(round(abs(lbd_end - lbd_ini)/lbd_step + 1e-9))
+    return lbd_ini + np.sign(lbd_end - lbd_ini)*lbd_step*np.arange(n_steps + 1)
+
+def _stepped_commands(lbd_ini, lbd_end, lbd_step, dwell, trigger, lbd_unit, sweep_repeat_mode, sweep_max_cycles):
+    """ Commands configuring a stepped sweep (see T100R.Sweep.stepped). """
+    return ['SOURce:WAVelength:SWEep:MODE STEPped',
+            'SOURce:WAVelength:SWEep:REPeat '+sweep_repeat_mode,
+            'SOURce:WAVelength:SWEep:CYCLES '+ str(sweep_max_cycles),
+            'SOURce:WAVelength:SWEep:STEP:WIDTh {:.3f} '.format(abs(lbd_step)) + lbd_unit,
+            'SOURce:WAVelength:SWEep:DWELl ' + ('MIN' if dwell is None else '{:.3f} S'.format(dwell)),
+            'SOURce:WAVelength:SWEep:STARt {:.3f} '.format(lbd_ini)+lbd_unit,
+            'SOURce:WAVelength:SWEep:STOP {:.3f} '.format(lbd_end)+lbd_unit,
+            'TRIGger:OUTPut ' + (trigger_output if trigger is True else trigger or 'DISabled')]
+
+class T100R(scpi_lib.Batching):
     """ Instrument control of Tunics T100R - Tunable Laser
     Created on Tue Aug 24 21 18:00:31
     @author: Leticia Magalhaes
     """
     
-    def __init__(self, ip = ip, wavelength_mode = wavelength_mode, print_bool = True, power_default = 3):
+    def __init__(self, ip = ip, wavelength_mode = wavelength_mode, print_bool = True, power_default = 3, port = 50000,
+                 calib_date = None, timeout = 5):
         
         #setting parameters:
         self.sweep_mode = sweep_mode
@@ -36,8 +261,12 @@ class T100R:
         self.sweep_max_cycles = sweep_max_cycles
         self.wavelength_mode = wavelength_mode
         self.ip_addr = ip
+        self.port = port
+        self.calib_date = calib_date #wavelength calibration in use at this date (None: latest)
         self.print_bool = print_bool
         self.power_default = power_default
+        self.timeout = timeout #[s] socket timeout
+        self._received = b''
 
 
         #instantiating inner classes
@@ -56,22 +285,29 @@ class T100R:
             self.tunics = None
             raise Exception('Tunics T100R: Could not open socket.')
 
-        self.tunics.connect((self.ip_addr, 50000))
+        self.tunics.settimeout(self.timeout)
+        self.tunics.connect((self.ip_addr, self.port))
+        self._received = b''
         try:
             self.tunics.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         except:
             print('Tunics T100R:Error setting socket options')
             
-        self.query('SOURce:WAVelength:MODE '+ wavelength_mode)
+        self.query('SOURce:WAVelength:MODE '+ self.wavelength_mode)
         print("Tunics connected. IDN: ", self.query("*IDN?"))
         
 
-    def read(self, input_buffer = 2**33):
+    def read(self, input_buffer = 2**16):
         '''
-        Tunics read
+        Tunics read: receives up to the end of one reply (read_termination), which is returned without it.
         '''
-        idn = self.tunics.recv(input_buffer)
-        return idn.decode('ascii')
+        reply, self._received = _split_reply(self._received)
+        while reply is None:
+            data = self.tunics.recv(input_buffer)
+            if not data:
+                raise Exception('TUNICS: connection closed.')
+            reply, self._received = _split_reply(self._received + data)
+        return reply
 
     def send(self, msg):
         """ Sends command to tunics.
@@ -79,16 +315,27 @@ class T100R:
             msg (str): any command defined in the manual.
         """
         try:
-            self.tunics.send(msg.encode('ascii'))
+            self.tunics.sendall((msg + write_termination).encode('ascii'))
         except:
             raise Exception('TUNICS: Error sending msg.')
 
 
-    def query(self, msg, input_buffer = 2**33):
+    def write(self, msg):
+        """ Sends a setting command and returns the acknowledgement of tunics.
+        Inside `with tunics.batch():` commands are buffered and sent as a single message (joined by ';').
+        The laser acknowledges a message once ('OK'), whatever the number of commands in it, and read
+        takes the whole reply up to read_termination, so no acknowledgement is left for the next query.
+        Args:
+            msg (str): any command defined in the manual.
+        """
+        if self._batched(msg): return
+        return self.query(msg)
+
+    def query(self, msg, input_buffer = 2**16):
         """ Queries tunics: send a message and reads the output.
         Args:
             msg (str): Any of the commands defined in the manual
-            input_buffer (int, optional):  Defaults to 2**33.
+            input_buffer (int, optional):  Defaults to 2**16.
         Returns:
             [type]: [description]
         """
@@ -152,8 +399,17 @@ class T100R:
             return output
 
     class Wavelength:
-        def __init__(self, outer, wavelength_correction=wavelength_correction):
+        def __init__(self, outer, wavelength_correction=None):
+            """
+            Args:
+                wavelength_correction (WavelengthCorrection or dict, optional): Defaults to the calibration in
+                                                                               use at outer.calib_date.
+            """
             self.outer = outer
+            if wavelength_correction is None:
+                wavelength_correction = load_wavelength_correction(outer.calib_date)
+            elif isinstance(wavelength_correction, dict):
+                wavelength_correction = WavelengthCorrection.from_dict(wavelength_correction)
             self.wavelength_correction = wavelength_correction
 
         def _query(self, msg):
@@ -163,16 +419,12 @@ class T100R:
             self.outer.send(msg)
 
         def lbd_nominal(self, lbd):
-            a = self.wavelength_correction['slope']
-            b = self.wavelength_correction['intercept']
-
-            return lbd - (a*lbd+b)
+            """ Nominal (laser) wavelength(s) giving the real wavelength(s) lbd. """
+            return self.wavelength_correction.lbd_nominal(lbd)
         
         def lbd_real(self, lbd_nom):
-            a = self.wavelength_correction['slope']
-            b = self.wavelength_correction['intercept']
-
-            return lbd_nom + (a*lbd_nom+b)
+            """ Real wavelength(s) of the nominal (laser) wavelength(s) lbd_nom, e.g. a whole sweep axis. """
+            return self.wavelength_correction.lbd_real(lbd_nom)
         
         def set_lbd(self, lbd_nm, lbd_unit = 'NM'):
             output = self._query('SOURce:WAVelength {:.3f} '.format(lbd_nm) + lbd_unit)
@@ -224,35 +476,72 @@ class T100R:
         def _read(self):
             return self.outer.read()
 
+        def _write(self, msg):
+            return self.outer.write(msg)
+
         def config(self, lbd_nm_ini , lbd_nm_end, lbd_nms_speed, 
                 lbd_unit = 'NM', lbd_speed_unit = 'NM/S',
                 sweep_mode = None, sweep_repeat_mode = None, 
                 sweep_max_cycles = None):
             '''
             '''
-            #optional parameters
-            if sweep_mode is None:
-                self._query('SOURce:WAVelength:SWEep:MODE '+self.outer.sweep_mode)
-            else:
-                self._query('SOURce:WAVelength:SWEep:MODE '+sweep_mode)
+            with self.outer.batch():
+                #optional parameters
+                if sweep_mode is None:
+                    self._write('SOURce:WAVelength:SWEep:MODE '+self.outer.sweep_mode)
+                else:
+                    self._write('SOURce:WAVelength:SWEep:MODE '+sweep_mode)
 
-            if sweep_repeat_mode is None:
-                self._query('SOURce:WAVelength:SWEep:REPeat '+self.outer.sweep_repeat_mode)
-            else:
-                self._query('SOURce:WAVelength:SWEep:REPeat '+sweep_repeat_mode)
+                if sweep_repeat_mode is None:
+                    self._write('SOURce:WAVelength:SWEep:REPeat '+self.outer.sweep_repeat_mode)
+                else:
+                    self._write('SOURce:WAVelength:SWEep:REPeat '+sweep_repeat_mode)
 
-            if sweep_max_cycles is None:
-                self._query('SOURce:WAVelength:SWEep:CYCLES '+ str(self.outer.sweep_max_cycles))
-            else:
-                self._query('SOURce:WAVelength:SWEep:CYCLES '+ str(sweep_max_cycles))
-            
-            #non-optional
-            self._query("SOURce:WAVelength:SWEep:DWELl MIN")
-            self._query('SOURce:WAVelength:SWEep:STARt {:.3f} '.format(lbd_nm_ini)+lbd_unit)
-            self._query('SOURce:WAVelength:SWEep:STOP {:.3f} '.format(lbd_nm_end)+lbd_unit)
-            self._query('SOURce:WAVelength:SWEep:SPEed {:.3f} '.format(lbd_nms_speed)+lbd_speed_unit)
+                if sweep_max_cycles is None:
+                    self._write('SOURce:WAVelength:SWEep:CYCLES '+ str(self.outer.sweep_max_cycles))
+                else:
+                    self._write('SOURce:WAVelength:SWEep:CYCLES '+ str(sweep_max_cycles))
+                
+                #non-optional
+                self._write("SOURce:WAVelength:SWEep:DWELl MIN")
+                self._write('SOURce:WAVelength:SWEep:STARt {:.3f} '.format(lbd_nm_ini)+lbd_unit)
+                self._write('SOURce:WAVelength:SWEep:STOP {:.3f} '.format(lbd_nm_end)+lbd_unit)
+                self._write('SOURce:WAVelength:SWEep:SPEed {:.3f} '.format(lbd_nms_speed)+lbd_speed_unit)
             return self._query('*OPC?')
 
+        def stepped(self, lbd_nm_ini, lbd_nm_end, lbd_nm_step, dwell = None, trigger = True,
+                lbd_unit = 'NM', sweep_repeat_mode = None, sweep_max_cycles = 1):
+            """ Configures a hardware-timed stepped sweep: once started, the laser steps by itself, staying
+            dwell seconds at each wavelength and pulsing its trigger output, so that an external acquisition
+            can run without one TCP round trip per point.
+            Args:
+                lbd_nm_ini (float): first wavelength.
+                lbd_nm_end (float): last wavelength.
+                lbd_nm_step (float): step width.
+                dwell (float, optional): time at each wavelength [s]. Defaults to None (minimum dwell).
+                trigger (bool or str, optional): True for trigger_output, False to disable it, or any option of
+                                                trigger_output. Defaults to True.
+                lbd_unit (str, optional): Wavelength unit (can be: 'M', 'NM'). Defaults to 'NM'.
+                sweep_repeat_mode (str, optional): Defaults to self.outer.sweep_repeat_mode.
+                sweep_max_cycles (int, optional): Defaults to 1.
+            Returns:
+                array: nominal wavelengths of one pass, in lbd_unit (use wavelength.lbd_real to correct them).
+
+            Example:
+                lbd = tunics.sweep.stepped(1550, 1553, 0.003, dwell = 0.01)
+                tunics.sweep.start()
+                tunics.sweep.wait(len(lbd)*0.01 + 5)
+                lbd = tunics.wavelength.lbd_real(lbd)
+            """
+            if sweep_repeat_mode is None: sweep_repeat_mode = self.outer.sweep_repeat_mode
+
+            with self.outer.batch():
+                for msg in _stepped_commands(lbd_nm_ini, lbd_nm_end, lbd_nm_step, dwell, trigger, lbd_unit,
+                                             sweep_repeat_mode, sweep_max_cycles):
+                    self._write(msg)
+            self._query('*OPC?')
+            return stepped_wavelengths(lbd_nm_ini, lbd_nm_end, lbd_nm_step)
+
         def start(self):
             self._send('SOURce:WAVelength:SWEep:STATe?')
             is_sweeping = self._read()
@@ -275,17 +564,268 @@ class T100R:
             self._send("SOURce:WAVelength:SWEep:STATe?")
             return int(self._read())
         
-        def wait(self, max_time):
+        def wait(self, max_time, poll_interval = poll_interval):
             time0 = time.time()
             while time.time()-time0<max_time:
                 if self.is_running():
                     if self.outer.print_bool: print(".", end="")
+                    time.sleep(poll_interval)
                 else:
                     if self.outer.print_bool: print("Sweep finished")
                     return 1
             print("sweep not finished")
             return 0
 
+
+class AsyncT100R:
+    """ asyncio client of Tunics T100R - Tunable Laser
+
+    Keeps one connection open. Requests are queued and sent one at a time, each reply is read up to
+    read_termination, so replies never split or merge. Coroutines of different instruments can run
+    concurrently, e.g. awaiting the end of a sweep while the scope and OSA acquire.
+
+    Example:
+    -------
+    async def scan():
+        async with AsyncT100R() as tunics:
+            await tunics.sweep.config(1530, 1565, 5)
+            await tunics.sweep.start()
+            await asyncio.gather(tunics.sweep.wait(10), acquire_scope())
+
+    asyncio.get_event_loop().run_until_complete(scan())
+    """
+
+    def __init__(self, ip = ip, port = 50000, wavelength_mode = wavelength_mode, print_bool = True, power_default = 3,
+                 timeout = 5, calib_date = None):
+        
+        #setting parameters:
+        self.sweep_mode = sweep_mode
+        self.sweep_repeat_mode = sweep_repeat_mode
+        self.sweep_max_cycles = sweep_max_cycles
+        self.wavelength_mode = wavelength_mode
+        self.ip_addr = ip
+        self.port = port
+        self.calib_date = calib_date
+        self.print_bool = print_bool
+        self.power_default = power_default
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+        self._requests = None
+        self._worker = None
+
+        #instantiating inner classes
+        self.power = self.Power(self)
+        self.wavelength = self.Wavelength(self)
+        self.sweep = self.Sweep(self)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip_addr, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            raise Exception('Tunics T100R: Could not open socket.')
+
+        self._requests = asyncio.Queue()
+        self._worker = asyncio.ensure_future(self._serve())
+
+        await self.query('SOURce:WAVelength:MODE '+ self.wavelength_mode)
+        print("Tunics connected. IDN: ", await self.query("*IDN?"))
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self.writer is not None:
+            self.writer.close()
+            if hasattr(self.writer, 'wait_closed'): #Python 3.7+
+                try:
+                    await self.writer.wait_closed()
+                except OSError:
+                    pass
+            self.writer = None
+
+    async def query(self, msg):
+        """ Queues a message and waits for its reply line (without terminator).
+        Args:
+            msg (str): Any of the commands defined in the manual
+        Returns:
+            str: reply of tunics.
+        """
+        if self._worker is None or self._worker.done():
+            raise Exception('Tunics T100R: not connected.')
+        future = asyncio.get_event_loop().create_future()
+        await self._requests.put((msg, future))
+        return await future
+
+    async def _serve(self):
+        """ Sends queued requests one at a time and resolves them with their replies.
+        A request without a reply closes the connection, since a late reply would be taken by the next one. """
+        terminator = read_termination.encode('ascii')
+        while True:
+            msg, future = await self._requests.get()
+            if future.cancelled():
+                continue
+            try:
+                self.writer.write((msg + write_termination).encode('ascii'))
+                await self.writer.drain()
+                reply = await asyncio.wait_for(self.reader.readuntil(terminator), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if not future.done():
+                    future.set_exception(Exception('Tunics T100R: no reply to ' + msg + ' ({})'.format(repr(e))))
+                self.writer.close()
+                while not self._requests.empty():
+                    msg, future = self._requests.get_nowait()
+                    if not future.done():
+                        future.set_exception(Exception('Tunics T100R: connection closed.'))
+                return
+            if not future.done():
+                future.set_result(_split_reply(reply)[0])
+
+
+    class Power():
+        def __init__(self, outer):
+            self.outer = outer
+
+        async def _query(self, msg):
+            return await self.outer.query(msg)
+
+        async def set_pow(self, pow_val, pow_unit = 'MW'):
+            return await self._query('SOURce:POWer {:.2f} '.format(pow_val)+pow_unit)
+
+        async def state(self):
+            return int(await self._query('SOURce:POWer:STATe?'))
+
+        async def on(self, pow_val = None, pow_unit = 'MW', lbd = None, lbd_unit = 'NM'):
+            """ Enables power output (see T100R.Power.on). """
+            if lbd is not None:
+                await self.outer.wavelength.set_lbd(lbd, lbd_unit=lbd_unit)
+                if self.outer.print_bool: print('Wavelength set to {:.2f} '.format(lbd)+lbd_unit)
+
+            if pow_val is not None:
+                await self.set_pow(pow_val, pow_unit)
+                if self.outer.print_bool: print('Power set to '+ str(pow_val)+pow_unit)
+
+            if await self.state():
+                output = 'OK'
+            else:
+                output = await self._query('SOURce:POWer:STATe ON')
+                await asyncio.sleep(0.3)
+            if self.outer.print_bool: print('Power ON: ' + output)
+            return output
+
+        async def off(self):
+            if await self.state():
+                output = await self._query('SOURce:POWer:STATe OFF')
+            else:
+                output = 'OK'
+            if self.outer.print_bool: print('Power OFF: ' + output)
+            return output
+
+    class Wavelength:
+        __init__ = T100R.Wavelength.__init__
+
+        async def _query(self, msg):
+            return await self.outer.query(msg)
+
+        lbd_nominal = T100R.Wavelength.lbd_nominal
+        lbd_real = T100R.Wavelength.lbd_real
+
+        async def set_lbd(self, lbd_nm, lbd_unit = 'NM'):
+            output = await self._query('SOURce:WAVelength {:.3f} '.format(lbd_nm) + lbd_unit)
+            await self._query("*OPC?")
+            return output
+
+        async def set_step(self, step, step_unit = "NM"):
+            return await self._query('SOURce:WAVelength:SWEep:STEP:WIDTh {:.3f} '.format(step) + step_unit)
+
+        async def step_next(self):
+            return await self._query('SOURce:WAVelength:SWEep:STEP:NEXT')
+
+        async def step_prev(self):
+            return await self._query('SOURce:WAVelength:SWEep:STEP:PREVious')
+
+        async def sense(self):
+            return await self._query('SOURce:WAVelength?')
+
+    class Sweep:
+        def __init__(self, outer):
+            self.outer = outer
+
+        async def _query(self, msg):
+            return await self.outer.query(msg)
+
+        async def config(self, lbd_nm_ini , lbd_nm_end, lbd_nms_speed, 
+                lbd_unit = 'NM', lbd_speed_unit = 'NM/S',
+                sweep_mode = None, sweep_repeat_mode = None, 
+                sweep_max_cycles = None):
+            """ Configures a sweep (see T100R.Sweep.config). """
+            if sweep_mode is None: sweep_mode = self.outer.sweep_mode
+            if sweep_repeat_mode is None: sweep_repeat_mode = self.outer.sweep_repeat_mode
+            if sweep_max_cycles is None: sweep_max_cycles = self.outer.sweep_max_cycles
+
+            for msg in ['SOURce:WAVelength:SWEep:MODE '+sweep_mode,
+                        'SOURce:WAVelength:SWEep:REPeat '+sweep_repeat_mode,
+                        'SOURce:WAVelength:SWEep:CYCLES '+ str(sweep_max_cycles),
+                        "SOURce:WAVelength:SWEep:DWELl MIN",
+                        'SOURce:WAVelength:SWEep:STARt {:.3f} '.format(lbd_nm_ini)+lbd_unit,
+                        'SOURce:WAVelength:SWEep:STOP {:.3f} '.format(lbd_nm_end)+lbd_unit,
+                        'SOURce:WAVelength:SWEep:SPEed {:.3f} '.format(lbd_nms_speed)+lbd_speed_unit]:
+                await self._query(msg)
+            return await self._query('*OPC?')
+
+        async def stepped(self, lbd_nm_ini, lbd_nm_end, lbd_nm_step, dwell = None, trigger = True,
+                lbd_unit = 'NM', sweep_repeat_mode = None, sweep_max_cycles = 1):
+            """ Configures a hardware-timed stepped sweep (see T100R.Sweep.stepped). Returns the nominal wavelengths. """
+            if sweep_repeat_mode is None: sweep_repeat_mode = self.outer.sweep_repeat_mode
+
+            for msg in _stepped_commands(lbd_nm_ini, lbd_nm_end, lbd_nm_step, dwell, trigger, lbd_unit,
+                                         sweep_repeat_mode, sweep_max_cycles):
+                await self._query(msg)
+            await self._query('*OPC?')
+            return stepped_wavelengths(lbd_nm_ini, lbd_nm_end, lbd_nm_step)
+
+        async def start(self):
+            if await self.is_running():
+                print('Wavelength Sweep Already Running')
+                output = 'OK'
+            else:
+                output = await self._query('SOURce:WAVelength:SWEep:STATe START')
+                print('Wavelength Sweep Starting')
+            return output
+
+        async def stop(self):
+            return await self._query('SOURce:WAVelength:SWEep:STATe STOP')
+
+        async def is_running(self):
+            return int(await self._query("SOURce:WAVelength:SWEep:STATe?"))
+
+        async def wait(self, max_time, poll_interval = poll_interval):
+            """ Waits (without blocking the event loop) until the sweep ends, polling its state every poll_interval seconds.
+            Returns:
+                int: 1 if the sweep finished before max_time, 0 otherwise.
+            """
+            time0 = time.time()
+            while time.time()-time0<max_time:
+                if not await self.is_running():
+                    if self.outer.print_bool: print("Sweep finished")
+                    return 1
+                await asyncio.sleep(poll_interval)
+            print("sweep not finished")
+            return 0
+
 #%%
 
 if __name__ == '__main__':
@@ -294,13 +834,14 @@ if __name__ == '__main__':
     tunics.connect()
 
     tunics.wavelength.set_lbd(1551)
-    tunics.wavelength.set_step(0.003)
     tunics.power.on(pow_val=1)
-    
-    print(tunics.query('SOURce:WAVelength:SWEep:STEP:WIDTh?'))
 
-    for ii in range(100):
-        tunics.wavelength.step_next()
+    #100 steps of 3 pm, timed by the laser (10 ms each, trigger pulse at each step)
+    dwell = 0.01
+    lbd = tunics.sweep.stepped(1551, 1551.3, 0.003, dwell = dwell)
+    tunics.sweep.start()
+    tunics.sweep.wait(len(lbd)*dwell + 5)
+    lbd = tunics.wavelength.lbd_real(lbd)
 
     #tunics.power.off()
 
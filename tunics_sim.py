@@ -0,0 +1,442 @@
+# %%
+"""
+Socket-level simulator of the Tunics T100R SCPI subset used by tunics_lib:
+power state, wavelength set/sense, step next/previous, sweep
+config/start/stop/state and trigger output. Sweeps take the time the laser would take
+(span/speed, or steps x dwell in STEPped mode, times the number of passes),
+so control loops can be benchmarked and regression-tested without the laser.
+
+Every message gets one reply: the query results joined by ';', or 'OK'.
+Messages and replies are framed as in tunics_lib (write_termination, read_termination).
+
+Example:
+-------
+python tunics_sim.py              # serves on port 50000 until Ctrl+C
+python tunics_sim.py --benchmark  # round-trip latency of T100R calls
+python tunics_sim.py --check      # checks the T100R and AsyncT100R replies against the simulator
+
+with tunics_sim.T100RSimulator(port=0) as sim:
+    tunics = tunics_lib.T100R(ip='127.0.0.1', port=sim.port)
+    tunics.connect()
+"""
+
+#%%
+import re
+import time
+import socket
+import argparse
+import threading
+import socketserver
+import tunics_lib
+
+#definitions
+idn = 'YENISTA OPTICS,T100R,SIMULATED,1.0'
+lbd_min, lbd_max = 1500.0, 1630.0 #[nm] tuning range
+latency = 0.002 #[s] processing time of each message
+settle_time = 0.05 #[s] time to settle after a wavelength change (*OPC? waits for it)
+dwell_min = 0.05 #[s] minimum dwell per step in STEPped sweeps
+speed_max = 100.0 #[nm/s]
+
+_units = {'NM': 1.0, 'M': 1e9, 'PM': 1e-3, 'UM': 1e3, 'S': 1.0, 'MS': 1e-3, 'US': 1e-6,
+          'NM/S': 1.0, 'M/S': 1e9, 'MW': 1.0, 'W': 1e3, 'UW': 1e-3, 'NW': 1e-6, 'PW': 1e-9, 'DBM': 1.0}
+
+
+def _mnemonic(node):
+    """Regex of a SCPI node written as in the manual ('SWEep' matches SWE and SWEEP)."""
+    short = ''.join(ch for ch in node if ch.isupper() or ch.isdigit() or ch == '*')
+    rest = node[len(short):].upper()
+    return re.escape(short) + ('(?:' + re.escape(rest) + ')?' if rest else '')
+
+def _header(pattern):
+    """Regex of a SCPI header, '[SOURce:]WAVelength' meaning an optional SOURce node."""
+    regex = ''
+    if pattern.startswith('['):
+        optional, pattern = pattern[1:].split(']', 1)
+        regex = '(?:' + _mnemonic(optional.rstrip(':')) + ':)?'
+    regex += ':'.join(_mnemonic(node) for node in pattern.split(':'))
+    return re.compile(regex + r'(\?)?$')
+
+
+class T100RSimulator:
+    """Simulated T100R state machine behind a threaded TCP server.
+
+    Args:
+        host (str, optional): Defaults to '127.0.0.1'.
+        port (int, optional): Defaults to 50000 (as the laser). 0 picks a free port (see self.port).
+        latency (float, optional): processing time of each message [s].
+        settle_time (float, optional): settling time after a wavelength change [s].
+        dwell_min (float, optional): dwell of 'DWELl MIN' in STEPped sweeps [s].
+    """
+
+    def __init__(self, host = '127.0.0.1', port = 50000, latency = latency, settle_time = settle_time,
+                 dwell_min = dwell_min):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.settle_time = settle_time
+        self.dwell_min = dwell_min
+
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        self.n_messages = 0
+        self.reset()
+
+        self.commands = [(_header(pattern), handler) for pattern, handler in [
+            ('*IDN', self._idn),
+            ('*OPC', self._opc),
+            ('*RST', self._rst),
+            ('*CLS', self._cls),
+            ('SYSTem:ERRor', self._error),
+            ('[SOURce:]POWer:STATe', self._power_state),
+            ('[SOURce:]POWer', self._power),
+            ('[SOURce:]WAVelength:MODE', self._wavelength_mode),
+            ('[SOURce:]WAVelength:SWEep:STEP:WIDTh', self._step_width),
+            ('[SOURce:]WAVelength:SWEep:STEP:NEXT', self._step_next),
+            ('[SOURce:]WAVelength:SWEep:STEP:PREVious', self._step_prev),
+            ('[SOURce:]WAVelength:SWEep:MODE', self._sweep_mode),
+            ('[SOURce:]WAVelength:SWEep:REPeat', self._sweep_repeat),
+            ('[SOURce:]WAVelength:SWEep:CYCLes', self._sweep_cycles),
+            ('[SOURce:]WAVelength:SWEep:DWELl', self._sweep_dwell),
+            ('[SOURce:]WAVelength:SWEep:STARt', self._sweep_start),
+            ('[SOURce:]WAVelength:SWEep:STOP', self._sweep_stop),
+            ('[SOURce:]WAVelength:SWEep:SPEed', self._sweep_speed),
+            ('[SOURce:]WAVelength:SWEep:STATe', self._sweep_state),
+            ('[SOURce:]WAVelength', self._wavelength),
+            ('TRIGger:OUTPut', self._trigger_output),
+        ]]
+
+    #server
+    def start(self):
+        """Starts serving in a background thread."""
+        sim = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                buffer = ''
+                while True:
+                    data = self.request.recv(2**16)
+                    if not data:
+                        return
+                    #complete messages only, the rest waits for the next chunk
+                    buffer += data.decode('ascii')
+                    *messages, buffer = buffer.split(tunics_lib.write_termination)
+                    for msg in messages:
+                        if msg.strip():
+                            reply = sim.handle(msg) + tunics_lib.read_termination
+                            self.request.sendall(reply.encode('ascii'))
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    #messages
+    def handle(self, msg):
+        """Processes one message (commands separated by ';') and returns its reply (without terminator)."""
+        time.sleep(self.latency)
+        replies = []
+        with self.lock:
+            self.n_messages += 1
+            for cmd in msg.strip().split(';'):
+                cmd = cmd.strip().lstrip(':')
+                if not cmd:
+                    continue
+                header, _, arg = cmd.partition(' ')
+                for regex, handler in self.commands:
+                    match = regex.match(header.upper())
+                    if match:
+                        try:
+                            reply = handler(arg.strip(), match.group(1) == '?')
+                        except (ValueError, IndexError, KeyError):
+                            self.errors.append('-224,"Illegal parameter value"')
+                            reply = None
+                        break
+                else:
+                    self.errors.append('-113,"Undefined header"')
+                    reply = None
+                if reply is not None:
+                    replies.append(reply)
+        return ';'.join(replies) if replies else 'OK'
+
+    def reset(self):
+        self.errors = []
+        self.power_on = False
+        self.power_value = 1.0 #mW
+        self.lbd = 1550.0 #nm
+        self.settled_at = 0.0
+        self.mode = 'BASIC'
+        self.step = 0.001 #nm
+        self.sweep = {'mode': 'CONTINUOUS', 'repeat': 'ONEWAY', 'cycles': 1, 'dwell': None,
+                      'start': 1530.0, 'stop': 1565.0, 'speed': 5.0}
+        self.sweep_t0 = None
+        self.trigger = 'DISABLED'
+
+    #sweep timing
+    def sweep_duration(self):
+        """Duration of the configured sweep [s] (all passes)."""
+        passes = self.sweep['cycles']*(2 if self.sweep['repeat'].startswith('TWO') else 1)
+        return passes*self.pass_duration()
+
+    def pass_duration(self):
+        span = abs(self.sweep['stop'] - self.sweep['start'])
+        if self.sweep['mode'].startswith('STEP'):
+            return self.n_steps()*self.dwell()
+        return span/self.sweep['speed']
+
+    def n_steps(self):
+        return int(round(abs(self.sweep['stop'] - self.sweep['start'])/self.step)) + 1
+
+    def dwell(self):
+        return self.dwell_min if self.sweep['dwell'] is None else max(self.sweep['dwell'], self.dwell_min)
+
+    def _update(self):
+        """Updates the wavelength of a running sweep (or ends it)."""
+        if self.sweep_t0 is None:
+            return
+        t = time.time() - self.sweep_t0
+        duration = self.sweep_duration()
+        pass_duration = self.pass_duration()
+        start, stop = self.sweep['start'], self.sweep['stop']
+
+        if t >= duration:
+            n_passes = round(duration/pass_duration) if pass_duration > 0 else 1
+            self.lbd = start if (self.sweep['repeat'].startswith('TWO') and n_passes%2 == 0) else stop
+            self.sweep_t0 = None
+            return
+
+        n_pass, frac = divmod(t/pass_duration, 1) if pass_duration > 0 else (0, 1)
+        if self.sweep['repeat'].startswith('TWO') and int(n_pass)%2 == 1:
+            start, stop = stop, start
+        if self.sweep['mode'].startswith('STEP'):
+            n = min(int(frac*self.n_steps()), self.n_steps()-1)
+            self.lbd = start + (self.step if stop > start else -self.step)*n
+        else:
+            self.lbd = start + frac*(stop - start)
+
+    def running(self):
+        self._update()
+        return self.sweep_t0 is not None
+
+    #handlers: (argument, is_query) => reply or None
+    def _value(self, arg, default_unit):
+        match = re.match(r'([-+0-9.eE]+)\s*([A-Za-z/]*)$', arg)
+        if match is None:
+            raise ValueError(arg)
+        return float(match.group(1))*_units[(match.group(2) or default_unit).upper()]
+
+    def _idn(self, arg, query):
+        return idn
+
+    def _opc(self, arg, query):
+        if query:
+            #blocks until the wavelength settled, as the laser does
+            time.sleep(max(0, self.settled_at - time.time()))
+            return '1'
+
+    def _rst(self, arg, query):
+        self.reset()
+
+    def _cls(self, arg, query):
+        self.errors = []
+
+    def _error(self, arg, query):
+        return self.errors.pop(0) if self.errors else '+0,"No error"'
+
+    def _power_state(self, arg, query):
+        if query:
+            return '1' if self.power_on else '0'
+        self.power_on = arg.upper() in ('ON', '1')
+
+    def _power(self, arg, query):
+        if query:
+            return '{:.3f}'.format(self.power_value)
+        self.power_value = self._value(arg, 'MW')
+
+    def _wavelength_mode(self, arg, query):
+        if query:
+            return self.mode
+        self.mode = arg.upper()
+
+    def _wavelength(self, arg, query):
+        if query:
+            self._update()
+            return '{:.12E}'.format(1e-9*self.lbd) #in meters
+        lbd = self._value(arg, 'NM')
+        if not lbd_min <= lbd <= lbd_max:
+            raise ValueError(arg)
+        self.sweep_t0 = None
+        self._move(lbd)
+
+    def _move(self, lbd):
+        self.lbd = lbd
+        self.settled_at = time.time() + self.settle_time
+
+    def _step_width(self, arg, query):
+        if query:
+            return '{:.12E}'.format(1e-9*self.step)
+        self.step = self._value(arg, 'NM')
+
+    def _step_next(self, arg, query):
+        self._move(min(self.lbd + self.step, lbd_max))
+
+    def _step_prev(self, arg, query):
+        self._move(max(self.lbd - self.step, lbd_min))
+
+    def _sweep_mode(self, arg, query):
+        if query:
+            return self.sweep['mode']
+        self.sweep['mode'] = arg.upper()
+
+    def _sweep_repeat(self, arg, query):
+        if query:
+            return self.sweep['repeat']
+        self.sweep['repeat'] = arg.upper()
+
+    def _sweep_cycles(self, arg, query):
+        if query:
+            return str(self.sweep['cycles'])
+        self.sweep['cycles'] = max(1, int(float(arg)))
+
+    def _sweep_dwell(self, arg, query):
+        if query:
+            return '{:.3f}'.format(self.dwell())
+        self.sweep['dwell'] = None if arg.upper() == 'MIN' else self._value(arg, 'S')
+
+    def _sweep_start(self, arg, query):
+        if query:
+            return '{:.12E}'.format(1e-9*self.sweep['start'])
+        self.sweep['start'] = self._value(arg, 'NM')
+
+    def _sweep_stop(self, arg, query):
+        if query:
+            return '{:.12E}'.format(1e-9*self.sweep['stop'])
+        self.sweep['stop'] = self._value(arg, 'NM')
+
+    def _sweep_speed(self, arg, query):
+        if query:
+            return '{:.3f}'.format(self.sweep['speed'])
+        self.sweep['speed'] = min(self._value(arg, 'NM/S'), speed_max)
+
+    def _trigger_output(self, arg, query):
+        if query:
+            return self.trigger
+        self.trigger = arg.upper()
+
+    def _sweep_state(self, arg, query):
+        if query:
+            return '+1' if self.running() else '+0'
+        if arg.upper() in ('START', '1'):
+            self.lbd = self.sweep['start']
+            self.sweep_t0 = time.time()
+        elif arg.upper() in ('STOP', '0'):
+            self._update()
+            self.sweep_t0 = None
+        else:
+            raise ValueError(arg)
+
+
+def benchmark(n = 200):
+    """Round-trip latency of tunics_lib.T100R calls against a local simulator (without settling time)."""
+    with T100RSimulator(port=0, settle_time=0) as sim:
+        tunics = tunics_lib.T100R(ip=sim.host, port=sim.port, print_bool=False)
+        tunics.connect()
+        for name, func in [('query *IDN?', lambda: tunics.query('*IDN?')),
+                           ('wavelength.step_next', tunics.wavelength.step_next),
+                           ('wavelength.set_lbd', lambda: tunics.wavelength.set_lbd(1550)),
+                           ('sweep.config', lambda: tunics.sweep.config(1530, 1565, 5))]:
+            t0 = time.perf_counter()
+            for ii in range(n):
+                func()
+            print('{:<24}{:>10.3f} ms'.format(name, 1e3*(time.perf_counter()-t0)/n))
+        tunics.tunics.close()
+
+
+def check():
+    """Checks that the state checks and replies of tunics_lib clients match the simulator.
+
+    Raises:
+        AssertionError: on the first mismatch.
+    """
+    import io
+    import asyncio
+    import contextlib
+
+    with T100RSimulator(port=0, settle_time=0.01, dwell_min=0.01) as sim:
+        tunics = tunics_lib.T100R(ip=sim.host, port=sim.port, print_bool=False)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            tunics.connect()
+            assert tunics.query('*IDN?') == idn
+
+            #power: the second call must take the 'Already' branch
+            assert tunics.power.on() == 'OK' and sim.power_on
+            assert tunics.power.on() == 'OK'
+            assert tunics.power.off() == 'OK' and not sim.power_on
+            assert tunics.power.off() == 'OK'
+            assert 'Output Power Already Enabled' in out.getvalue()
+            assert 'Output Power Already Disabled' in out.getvalue()
+
+            #batched config: one acknowledgement, nothing left for the next query
+            assert tunics.sweep.config(1550, 1551, 5) == '1'
+            assert tunics.query('*IDN?') == idn and tunics._received == b''
+            assert sim.sweep['start'] == 1550 and sim.sweep['stop'] == 1551 and not sim.errors
+
+            #sweep: start while running must not restart it
+            tunics.sweep.start()
+            assert tunics.sweep.is_running() == 1
+            tunics.sweep.start()
+            assert 'Wavelength Sweep Already Running' in out.getvalue()
+            assert tunics.sweep.wait(2) == 1 and tunics.sweep.is_running() == 0
+
+            lbd = tunics.sweep.stepped(1550, 1550.01, 0.005, dwell=0.01)
+            assert len(lbd) == 3 and sim.n_steps() == 3 and not sim.errors
+
+            async def run():
+                async with tunics_lib.AsyncT100R(ip=sim.host, port=sim.port, print_bool=False) as client:
+                    assert await client.power.on() == 'OK' and await client.power.state() == 1
+                    assert await client.sweep.config(1540, 1541, 10) == '1'
+                    await client.sweep.start()
+                    assert await client.sweep.wait(2) == 1
+            asyncio.get_event_loop().run_until_complete(run())
+        tunics.tunics.close()
+    print('tunics_lib clients match the simulator')
+
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Tunics T100R simulator.")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 50000)
+    parser.add_argument('--latency', type = float, default = latency, help = "processing time of each message [s]")
+    parser.add_argument('--benchmark', action = 'store_true', help = "measure T100R round trips and exit")
+    parser.add_argument('--check', action = 'store_true', help = "check the tunics_lib clients and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+    elif args.benchmark:
+        benchmark()
+    else:
+        sim = T100RSimulator(host = args.host, port = args.port, latency = args.latency).start()
+        print('T100R simulator on {}:{} (Ctrl+C to stop)'.format(sim.host, sim.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            sim.stop()